@@ -0,0 +1,390 @@
+"""
+Bandwidth histories of routers, from the bandwidth files in the metrics
+data dir.
+
+The metrics data dir has one bandwidth file per router, named after the
+router's fingerprint (the hashed fingerprint for bridges), with the bytes
+written and read by the router in consecutive intervals, one per line:
+
+    w 2012-06-01 00:00:00 2012-06-01 00:15:00 1234567
+    r 2012-06-01 00:00:00 2012-06-01 00:15:00 2345678
+
+Recent intervals are typically 15 minutes long and older ones longer.
+When a file is read, each of its histories is downsampled into the
+fixed-interval graphs in GRAPHS, and only those are kept.  Each graph has
+a buffer with a block of values per router, and each value is stored
+normalized to 0..MAX_VALUE together with a factor per router and history,
+the way the bandwidth document encodes them.  Serving a graph of a router
+only reads its block, so requests for some of the graphs do not touch the
+others.
+"""
+
+import array
+import bisect
+import calendar
+import logging
+import os
+import time
+
+from pyonionoo.encoder import encode_string
+
+# Graphs of every history:  name, interval length in seconds and number
+# of intervals.
+GRAPHS = (('3_days', 15 * 60, 288),
+          ('1_week', 60 * 60, 168),
+          ('1_month', 4 * 60 * 60, 180),
+          ('3_months', 12 * 60 * 60, 180),
+          ('1_year', 2 * 24 * 60 * 60, 183),
+          ('5_years', 10 * 24 * 60 * 60, 183))
+
+GRAPH_NAMES = tuple(name for name, interval, count in GRAPHS)
+
+# Histories of a router, in output order:  member name and line prefix in
+# bandwidth files.
+HISTORIES = (('write_history', 'w'), ('read_history', 'r'))
+
+# Normalized values range from 0 to MAX_VALUE; intervals without enough
+# data have the value MISSING.
+MAX_VALUE = 999
+MISSING = -1
+
+# Fraction of a graph interval that the history must cover for the
+# interval to have a value.
+MIN_COVERAGE = 0.8
+
+# Array type code of normalized values.
+VALUE_TYPECODE = 'h'
+
+# JSON encoding of every normalized value, shifted by one for MISSING.
+ENCODED_VALUES = ['null'] + [str(value) for value in xrange(MAX_VALUE + 1)]
+
+def _format_time(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds))
+
+def read_histories(bandwidth_dir, fingerprint, times=None):
+    """
+    @type bandwidth_dir: string
+    @param bandwidth_dir: directory of the bandwidth files.
+
+    @type fingerprint: string
+    @param fingerprint: fingerprint of a relay or hashed fingerprint of a
+        bridge.
+
+    @type times: dict
+    @param times: parsed timestamps, by date and time of day; routers'
+        intervals mostly start and end at the same times, so pass the
+        same dict when reading many files.
+
+    @rtype: dict
+    @return: for each line prefix in HISTORIES, the intervals of that
+        history as a sorted list of (start, end, bytes) tuples, with
+        times in seconds since the epoch; or None if the router has no
+        bandwidth file or it cannot be read.
+    """
+
+    path = os.path.join(bandwidth_dir, fingerprint)
+    histories = dict((prefix, []) for history, prefix in HISTORIES)
+    if times is None:
+        times = {}
+
+    def parse_time(date, time_of_day):
+        seconds = times.get((date, time_of_day))
+        if seconds is None:
+            seconds = times[date, time_of_day] = calendar.timegm(
+                    time.strptime(date + time_of_day, "%Y-%m-%d%H:%M:%S"))
+        return seconds
+
+    try:
+        with open(path) as f:
+            for line in f:
+                values = line.split()
+                if len(values) != 6 or values[0] not in histories:
+                    continue
+                histories[values[0]].append((parse_time(values[1], values[2]),
+                                             parse_time(values[3], values[4]),
+                                             int(values[5])))
+    except IOError:
+        return None
+    except ValueError, e:
+        logging.error("Invalid bandwidth file %s: %s" % (path, e))
+        return None
+
+    for intervals in histories.itervalues():
+        intervals.sort()
+    return histories
+
+def downsample(intervals, starts, end, interval, count):
+    """
+    Downsample a history into a graph.  A history interval is counted in
+    the graph interval that contains it; intervals that are longer than
+    the graph interval or cross its boundaries are left out.
+
+    @type intervals: list of tuple
+    @param intervals: history intervals, see read_histories().
+
+    @type starts: list of int
+    @param starts: start of each of the history intervals.
+
+    @type end: int
+    @param end: end of the last graph interval.
+
+    @type interval: int
+    @param interval: length of graph intervals in seconds.
+
+    @type count: int
+    @param count: number of graph intervals.
+
+    @rtype: tuple
+    @return: tuple of form (factor, values), where values is an array of
+        the normalized bytes per second of each graph interval, and factor
+        what they must be multiplied by to get the actual ones.
+    """
+
+    start = end - interval * count
+    totals, covered = [0] * count, [0] * count
+    for first, last, value in intervals[bisect.bisect_left(starts, start):]:
+        position = (first - start) // interval
+        if last > end or last <= first or \
+                (last - 1 - start) // interval != position:
+            continue
+        totals[position] += value
+        covered[position] += last - first
+
+    rates = [float(total) / seconds if seconds >= interval * MIN_COVERAGE
+             else None for total, seconds in zip(totals, covered)]
+    known = [rate for rate in rates if rate is not None]
+    factor = max(known) / MAX_VALUE if known else 0.0
+    values = array.array(VALUE_TYPECODE, [
+            MISSING if rate is None else
+            int(round(rate / factor)) if factor else 0
+            for rate in rates])
+    return factor, values
+
+def _graph_end(end, interval):
+    # Graph intervals are aligned to multiples of their length.
+    return -(-int(end) // interval) * interval
+
+def build_bandwidth(snapshot, bandwidth_dir, previous=None, matched=None):
+    """
+    Build the bandwidth graphs of the routers of a snapshot.
+
+    The graphs of a router are taken over from previous if its bandwidth
+    file has not changed; only the other bandwidth files are read.
+
+    @type snapshot: Snapshot
+    @param snapshot: snapshot to build the bandwidth graphs of.
+
+    @type bandwidth_dir: string
+    @param bandwidth_dir: directory of the bandwidth files, or None.
+
+    @type previous: Snapshot
+    @param previous: previous snapshot, or None.
+
+    @type matched: list
+    @param matched: for each row of snapshot, the row of the same router
+        in previous, or None.
+
+    @rtype: tuple
+    @return: tuple of form (bandwidth, changed), where bandwidth is the
+        BandwidthStore and changed the number of routers whose graphs were
+        not taken over from previous, not counting routers that have no
+        bandwidth file and had none in previous.
+    """
+
+    previous_store = getattr(previous, 'bandwidth', None)
+    if previous_store is None or \
+            previous_store.bandwidth_dir != bandwidth_dir:
+        matched = None
+    if bandwidth_dir and not os.path.isdir(bandwidth_dir):
+        logging.error("Bandwidth directory %s not found" % bandwidth_dir)
+        bandwidth_dir = None
+
+    slots, mtimes, ends = array.array('i'), array.array('d'), array.array('d')
+    blocks = dict((name, []) for name in GRAPH_NAMES)
+    factors = dict((name, array.array('d')) for name in GRAPH_NAMES)
+    changed, times = 0, {}
+    for row in xrange(snapshot.size):
+        fingerprint = snapshot.fingerprint[row]
+        mtime = -1
+        if bandwidth_dir:
+            try:
+                mtime = os.stat(os.path.join(bandwidth_dir, fingerprint)).st_mtime
+            except OSError:
+                pass
+        mtimes.append(mtime)
+
+        previous_row = matched[row] if matched is not None else None
+        previous_mtime = -1
+        if previous_row is not None:
+            previous_mtime = previous_store.mtimes[previous_row]
+        if previous_row is not None and previous_mtime == mtime:
+            previous_slot = previous_store.slots[previous_row]
+            if previous_slot == -1:
+                slots.append(-1)
+                continue
+            slots.append(len(ends))
+            ends.append(previous_store.ends[previous_slot])
+            for name in GRAPH_NAMES:
+                blocks[name].append(previous_store.get_block(name, previous_slot))
+                factors[name].extend(previous_store.get_factors(name,
+                                                                previous_slot))
+            continue
+
+        # Routers that have no bandwidth file, and had none before, have
+        # no graphs to update.
+        if mtime != -1 or previous_mtime != -1:
+            changed += 1
+        histories = None
+        if mtime != -1:
+            histories = read_histories(bandwidth_dir, fingerprint, times)
+        if not histories or not any(histories.itervalues()):
+            slots.append(-1)
+            continue
+
+        end = max(intervals[-1][1] for intervals in histories.itervalues()
+                  if intervals)
+        starts = dict((prefix, [first for first, last, value in intervals])
+                      for prefix, intervals in histories.iteritems())
+        slots.append(len(ends))
+        ends.append(end)
+        for name, interval, count in GRAPHS:
+            graph_end = _graph_end(end, interval)
+            for history, prefix in HISTORIES:
+                factor, values = downsample(histories[prefix], starts[prefix],
+                                            graph_end, interval, count)
+                blocks[name].append(values.tostring())
+                factors[name].append(factor)
+
+    graphs = dict((name, (''.join(blocks[name]), 0, factors[name]))
+                  for name in GRAPH_NAMES)
+    return BandwidthStore(bandwidth_dir, slots, mtimes, ends, graphs), changed
+
+class BandwidthStore(object):
+    def __init__(self, bandwidth_dir, slots, mtimes, ends, graphs):
+        """
+        @type bandwidth_dir: string
+        @param bandwidth_dir: directory of the bandwidth files, or None.
+
+        @type slots: sequence of int
+        @param slots: slot of the graphs of every row, or -1 if the router
+            has no bandwidth history.
+
+        @type mtimes: sequence of float
+        @param mtimes: modification time of the bandwidth file of every
+            row, or -1 if it has none.
+
+        @type ends: sequence of float
+        @param ends: end of the last history interval of every slot.
+
+        @type graphs: dict of string -> tuple
+        @param graphs: for every graph name, a tuple of form (buffer,
+            offset, factors), where buffer holds from offset on, for every
+            slot, the normalized values of each history in HISTORIES (see
+            downsample()), and factors the factor of every slot and
+            history.
+        """
+
+        self.bandwidth_dir = bandwidth_dir
+        self.slots = slots
+        self.mtimes = mtimes
+        self.ends = ends
+        self.graphs = graphs
+        self.block_sizes = dict(
+                (name, count * len(HISTORIES) *
+                 array.array(VALUE_TYPECODE).itemsize)
+                for name, interval, count in GRAPHS)
+
+    def get_buffer(self, name):
+        """
+        @rtype: string
+        @return: the blocks of a graph of all slots, concatenated.
+        """
+
+        buffer, offset, factors = self.graphs[name]
+        return buffer[offset:offset + len(self.ends) * self.block_sizes[name]]
+
+    def get_block(self, name, slot):
+        """
+        @rtype: string
+        @return: the normalized values of a graph of every history of a
+            slot, as the bytes of an array.
+        """
+
+        buffer, offset, factors = self.graphs[name]
+        size = self.block_sizes[name]
+        start = offset + slot * size
+        return buffer[start:start + size]
+
+    def get_factors(self, name, slot):
+        """
+        @rtype: sequence of float
+        @return: the factor of a graph of every history of a slot.
+        """
+
+        factors = self.graphs[name][2]
+        return factors[slot * len(HISTORIES):(slot + 1) * len(HISTORIES)]
+
+    def iter_entries(self, snapshot, rows, graphs=None):
+        """
+        @type snapshot: Snapshot
+        @param snapshot: snapshot that this store belongs to.
+
+        @type rows: iterable of int
+        @param rows: rows to get the bandwidth entries of.
+
+        @type graphs: tuple of string
+        @param graphs: names of the graphs to include; all of them if None.
+
+        @rtype: iterator of string
+        @return: the JSON encoded bandwidth entry of every row.
+        """
+
+        graphs = [graph for graph in GRAPHS
+                  if graphs is None or graph[0] in graphs]
+        for row in rows:
+            parts = ['"fingerprint": %s' % encode_string(snapshot.fingerprint[row])]
+            slot = self.slots[row]
+            if slot != -1:
+                members = [[] for history in HISTORIES]
+                for name, interval, count in graphs:
+                    values = array.array(VALUE_TYPECODE)
+                    values.fromstring(self.get_block(name, slot))
+                    factors = self.get_factors(name, slot)
+                    for index in xrange(len(HISTORIES)):
+                        graph = _encode_graph(
+                                values[index * count:(index + 1) * count],
+                                factors[index], _graph_end(self.ends[slot], interval),
+                                interval)
+                        if graph is not None:
+                            members[index].append('%s: %s' % (
+                                    encode_string(name), graph))
+                for (history, prefix), graph_members in zip(HISTORIES, members):
+                    if graph_members:
+                        parts.append('%s: {%s}' % (encode_string(history),
+                                                   ', '.join(graph_members)))
+            yield '{' + ', '.join(parts) + '}'
+
+def _encode_graph(values, factor, end, interval):
+    """
+    @rtype: string
+    @return: JSON encoding of a graph, from its first to its last interval
+        with a value, or None if it has none.  Intervals are identified by
+        their midpoints.
+    """
+
+    first, last = 0, len(values) - 1
+    while first <= last and values[first] == MISSING:
+        first += 1
+    if first > last:
+        return None
+    while values[last] == MISSING:
+        last -= 1
+
+    start = end - interval * len(values) + interval // 2
+    return ('{"first": "%s", "last": "%s", "interval": %d, "factor": %r, '
+            '"count": %d, "values": [%s]}' % (
+            _format_time(start + first * interval),
+            _format_time(start + last * interval), interval, factor,
+            last - first + 1,
+            ', '.join([ENCODED_VALUES[value + 1]
+                       for value in values[first:last + 1]])))
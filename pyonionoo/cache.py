@@ -0,0 +1,120 @@
+"""
+Bounded LRU cache of encoded responses.
+
+Responses only change when a new snapshot is published, so every entry
+is tied to the generation of the snapshot it was computed from.  As soon
+as a lookup is made for another generation, all entries of the current
+one are dropped.  Generations are only compared for equality, so a
+restarted loader whose generations are lower than before is followed
+too.  Responses of other generations than the current one are not
+inserted, so that requests that were still answered from a replaced
+snapshot don't evict the responses of the new one.
+
+Responses for a snapshot that is not served yet can be staged with
+put_staged():  they are kept aside, without disturbing the responses of
+the snapshot being served, and replace them when the new generation is
+first looked up.
+"""
+
+import collections
+import threading
+
+class ResponseCache(object):
+    def __init__(self, max_entries):
+        """
+        @type max_entries: int
+        @param max_entries: maximum number of responses kept; 0 disables
+            the cache.
+        """
+
+        self.max_entries = max_entries
+        self.generation = None
+        self.entries = collections.OrderedDict()
+        self.staged_generation = None
+        self.staged_entries = None
+        self.hits = 0
+        self.misses = 0
+
+        # Entries are added from the request threads.
+        self.lock = threading.Lock()
+
+    def _set_generation(self, generation):
+        # Must be called with the lock held.
+        if generation == self.generation:
+            return
+        if generation == self.staged_generation:
+            self.entries = self.staged_entries
+            self.staged_generation = self.staged_entries = None
+        else:
+            self.entries = collections.OrderedDict()
+        self.generation = generation
+
+    def get(self, generation, key):
+        """
+        @type generation: int
+        @param generation: generation of the snapshot the response is for.
+
+        @type key: tuple
+        @param key: normalized request arguments, see arguments.normalize().
+
+        @rtype: string
+        @return: the cached response, or None.
+        """
+
+        with self.lock:
+            self._set_generation(generation)
+            value = self.entries.pop(key, None)
+            if value is not None:
+                # Re-insert to mark the entry as most recently used.
+                self.entries[key] = value
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, generation, key, value):
+        """
+        Cache a response, evicting the least recently used one if the
+        cache is full.  Responses computed from another snapshot than the
+        cached ones are ignored; see get().
+        """
+
+        if not self.max_entries:
+            return
+        with self.lock:
+            if self.generation is not None and generation != self.generation:
+                return
+            self._set_generation(generation)
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put_staged(self, generation, entries):
+        """
+        Cache responses for a snapshot that is about to be served, as
+        the only responses of its generation.  Until that generation is
+        looked up, the cached responses of the current one are kept.
+
+        @type generation: int
+        @param generation: generation of the new snapshot.
+
+        @type entries: list of tuple
+        @param entries: (key, response) tuples, most important last; the
+            first ones are dropped if there are more than max_entries.
+        """
+
+        if not self.max_entries:
+            return
+        with self.lock:
+            if generation == self.generation:
+                return
+            self.staged_generation = generation
+            self.staged_entries = collections.OrderedDict(
+                    entries[-self.max_entries:])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.staged_generation = self.staged_entries = None
@@ -0,0 +1,322 @@
+"""
+Compact, read-only column types for snapshots.
+
+Snapshot columns are sequences indexed by row.  Most of them are plain
+tuples or arrays, but a few attributes are stored in a more compact form
+and decoded when a row is accessed:
+
+  * HexColumn:  fixed-size binary values, such as fingerprints, kept in
+    a single contiguous buffer and returned as hexadecimal strings;
+  * FlagsColumn:  sets of relay flags, kept as bitmasks in an array;
+  * StringColumn:  variable-length strings kept in a single buffer, such
+    as a memory-mapped snapshot file;
+  * ArrayColumn:  numbers kept in a buffer in the native format of an
+    array, read from the buffer without copying it;
+  * ConvertedColumn:  any other column, with a conversion applied to its
+    values.
+
+All of them support len(), indexing and iteration, which is all that
+Snapshot and the handlers need.
+"""
+
+import array
+import struct
+
+from binascii import a2b_hex, b2a_hex
+
+# Marker for None in string tables.  No router attribute contains NUL.
+NULL = '\x00'
+
+class HexColumn(object):
+    def __init__(self, buffer, offset, count, width, upper):
+        """
+        @type buffer: string or mmap
+        @param buffer: buffer holding the binary values.
+
+        @type offset: int
+        @param offset: position of the first value in buffer.
+
+        @type count: int
+        @param count: number of values.
+
+        @type width: int
+        @param width: size in bytes of each value.
+
+        @type upper: bool
+        @param upper: whether to return upper-case hexadecimal strings.
+        """
+
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.width = width
+        self.upper = upper
+
+    @classmethod
+    def from_values(cls, values, width, upper):
+        """
+        @type values: iterable of string
+        @param values: hexadecimal strings of width bytes each.
+        """
+
+        buffer = ''.join(a2b_hex(value) for value in values)
+        if len(buffer) % width:
+            raise ValueError("Values are not all %d bytes long" % width)
+        return cls(buffer, 0, len(buffer) // width, width, upper)
+
+    @classmethod
+    def merge(cls, old, new, kept):
+        """
+        @type old: HexColumn
+        @param old: column to take kept values from.
+
+        @type new: HexColumn
+        @param new: column to take the other values from, in order.
+
+        @type kept: list
+        @param kept: for each value of the merged column, its index in
+            old, or None to take the next value of new.
+
+        @rtype: HexColumn
+        @return: merged column, with the width and case of new.
+        """
+
+        width = new.width
+        old_buffer, new_buffer = old.get_buffer(), new.get_buffer()
+        parts, position = [], 0
+        for index in kept:
+            if index is None:
+                parts.append(new_buffer[position:position + width])
+                position += width
+            else:
+                parts.append(old_buffer[index * width:(index + 1) * width])
+        return cls(''.join(parts), 0, len(kept), width, new.upper)
+
+    def get_buffer(self):
+        """
+        @rtype: string
+        @return: the binary values, concatenated.
+        """
+
+        return self.buffer[self.offset:self.offset + self.count * self.width]
+
+    def get_indexes(self):
+        """
+        @rtype: dict of string -> int
+        @return: index of each binary value.
+        """
+
+        buffer, width = self.get_buffer(), self.width
+        return dict((buffer[index * width:(index + 1) * width], index)
+                    for index in xrange(self.count))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        start = self.offset + index * self.width
+        value = b2a_hex(self.buffer[start:start + self.width])
+        return value.upper() if self.upper else value
+
+    def __iter__(self):
+        for index in xrange(self.count):
+            yield self[index]
+
+class FlagsColumn(object):
+    def __init__(self, masks, names):
+        """
+        @type masks: array
+        @param masks: bitmask of the flags of every row; bit i stands for
+            names[i].
+
+        @type names: tuple of string
+        @param names: flag names.
+
+        Bits are assigned in the order that flags are first seen, but
+        flags are returned sorted by name, so that they do not depend on
+        the order of routers or on how the column was built.
+        """
+
+        self.masks = masks
+        self.names = names
+        self.sorted_bits = tuple((name, 1 << names.index(name))
+                                 for name in sorted(names))
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        @type values: iterable of sequence of string
+        @param values: flags of every row.
+        """
+
+        bits = {}
+        masks = array.array('L')
+        for flags in values:
+            mask = 0
+            for flag in flags:
+                bit = bits.get(flag)
+                if bit is None:
+                    bit = bits[flag] = 1 << len(bits)
+                mask |= bit
+            masks.append(mask)
+        names = tuple(sorted(bits, key=bits.get))
+        return cls(masks, names)
+
+    @classmethod
+    def merge(cls, old, new, kept):
+        """
+        Like HexColumn.merge(), for FlagsColumn.
+        """
+
+        names = old.names + tuple(name for name in new.names
+                                  if name not in old.names)
+        bits = [1 << names.index(name) for name in new.names]
+        translated = {}
+        masks, new_masks = array.array('L'), iter(new.masks)
+        for index in kept:
+            if index is not None:
+                masks.append(old.masks[index])
+                continue
+            mask = new_masks.next()
+            if mask not in translated:
+                translated[mask] = sum(bit for position, bit in enumerate(bits)
+                                       if mask & (1 << position))
+            masks.append(translated[mask])
+        return cls(masks, names)
+
+    def get_mask(self, flag):
+        """
+        @rtype: int
+        @return: bit standing for flag in masks, or 0 if no row has it.
+        """
+
+        if flag in self.names:
+            return 1 << self.names.index(flag)
+        return 0
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __getitem__(self, index):
+        mask = self.masks[index]
+        return tuple(name for name, bit in self.sorted_bits if mask & bit)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+class ArrayColumn(object):
+    """
+    Numbers stored in a buffer as the items of an array, that is, in
+    native byte order and size.  Values are unpacked from the buffer when
+    they are accessed, so a memory-mapped buffer is never copied.
+    Slices are returned as tuples.
+    """
+
+    def __init__(self, buffer, offset, count, typecode):
+        """
+        @type buffer: string or mmap
+        @param buffer: buffer holding the values.
+
+        @type offset: int
+        @param offset: position of the first value in buffer.
+
+        @type count: int
+        @param count: number of values.
+
+        @type typecode: string
+        @param typecode: array type code of the values.
+        """
+
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.typecode = typecode
+        self.itemsize = struct.calcsize(typecode)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                return tuple(self[position]
+                             for position in xrange(start, stop, step))
+            return struct.unpack_from('%d%s' % (max(stop - start, 0),
+                                                self.typecode),
+                                      self.buffer,
+                                      self.offset + start * self.itemsize)
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return struct.unpack_from(self.typecode, self.buffer,
+                                  self.offset + index * self.itemsize)[0]
+
+    def __iter__(self):
+        for index in xrange(self.count):
+            yield self[index]
+
+class StringColumn(object):
+    """
+    Strings stored as a string table:  an array of count + 1 offsets,
+    followed by the concatenated strings.  Strings are sliced out of the
+    buffer when they are accessed.
+    """
+
+    def __init__(self, buffer, offset, count):
+        self.buffer = buffer
+        self.offsets = ArrayColumn(buffer, offset, count + 1, 'I')
+        self.base = offset + 4 * (count + 1)
+
+    @staticmethod
+    def encode(values):
+        """
+        @type values: iterable of string or None
+        @param values: strings to store.
+
+        @rtype: string
+        @return: string table of values.
+        """
+
+        values = [NULL if value is None else value for value in values]
+        offsets = array.array('I', [0])
+        position = 0
+        for value in values:
+            position += len(value)
+            offsets.append(position)
+        return offsets.tostring() + ''.join(values)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, end = self.offsets[index:index + 2]
+        value = self.buffer[self.base + start:self.base + end]
+        return None if value == NULL else value
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+class ConvertedColumn(object):
+    """
+    Read-only sequence applying a conversion to the values of another one.
+    """
+
+    def __init__(self, values, convert):
+        self.values = values
+        self.convert = convert
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.convert(self.values[index])
+
+    def __iter__(self):
+        for value in self.values:
+            yield self.convert(value)
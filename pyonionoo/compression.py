@@ -0,0 +1,134 @@
+"""
+Content encoding of responses.
+
+The content encoding of a response is negotiated from the client's
+Accept-Encoding header among the encodings enabled in the configuration.
+gzip is always available; brotli ('br') and zstd are used if the brotli
+and zstandard modules are installed.
+
+Responses are compressed at two levels:  responses computed for a
+request are compressed at a fast level while they are streamed, and
+responses found in the response cache, which are requested more than
+once per snapshot, are compressed once at a high level and the
+compressed variant is cached next to them.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Fast and high compression levels of each encoding.
+LEVELS = {
+    'gzip': (1, 9),
+    'br': (4, 11),
+    'zstd': (1, 19)
+}
+
+# Encodings that can be enabled, in the default order of preference.
+ENCODINGS = ('br', 'zstd', 'gzip')
+
+# Responses smaller than this many bytes are not compressed.
+MIN_SIZE = 1024
+
+class _BrotliCompressor(object):
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+def is_available(encoding):
+    """
+    @rtype: bool
+    @return: whether the module needed for encoding is installed.
+    """
+
+    if encoding == 'br':
+        return brotli is not None
+    if encoding == 'zstd':
+        return zstandard is not None
+    return encoding == 'gzip'
+
+def get_compressor(encoding, level):
+    """
+    @type encoding: string
+    @param encoding: content encoding, one of ENCODINGS.
+
+    @type level: int
+    @param level: compression level, see LEVELS.
+
+    @rtype: object
+    @return: incremental compressor, with a compress() method returning
+        the compressed data available so far and a flush() method
+        returning the rest of it.
+    """
+
+    if encoding == 'br':
+        return _BrotliCompressor(level)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def compress(data, encoding, level):
+    """
+    @rtype: string
+    @return: data compressed with encoding at level.
+    """
+
+    compressor = get_compressor(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+def negotiate(accept_encoding, encodings):
+    """
+    Choose the content encoding of a response, as per RFC 7231, section
+    5.3.4:  the encoding with the highest quality value in accept_encoding,
+    the first in encodings if several have the same one.
+
+    @type accept_encoding: string
+    @param accept_encoding: value of the Accept-Encoding request header.
+
+    @type encodings: list of string
+    @param encodings: enabled encodings, in order of preference.
+
+    @rtype: string
+    @return: the chosen encoding, or None if the response should not be
+        compressed.
+    """
+
+    if not accept_encoding or not encodings:
+        return None
+
+    qualities = {}
+    for element in accept_encoding.split(','):
+        parameters = element.split(';')
+        coding = parameters[0].strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        quality = 1.0
+        for parameter in parameters[1:]:
+            name, _, value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
@@ -63,4 +63,35 @@ def parse_config(filename):
 
     settings['metrics_out'] = xget(cfg.get, 'metrics', 'out_dir', '/tmp')
     settings['summary_file'] = xget(cfg.get, 'metrics', 'summary_file', 'summary')
+    settings['details_dir'] = xget(cfg.get, 'metrics', 'details_dir', 'details')
+    settings['bandwidth_dir'] = xget(cfg.get, 'metrics', 'bandwidth_dir',
+                                     'bandwidth')
+
+    # snapshot sharing between processes:  'standalone', 'loader' or 'worker'
+    settings['snapshot_mode'] = xget(cfg.get, 'snapshot', 'mode', 'standalone')
+    settings['snapshot_file'] = xget(cfg.get, 'snapshot', 'file',
+                                     '/tmp/pyonionoo.snapshot')
+    if settings['snapshot_mode'] not in ('standalone', 'loader', 'worker'):
+        raise ValueError("Invalid snapshot mode: %s" % settings['snapshot_mode'])
+
+    # size of the thread pool that requests and refreshes run in
+    settings['thread_pool_size'] = xget(cfg.getint, 'threads', 'pool_size', 10)
+    if settings['thread_pool_size'] < 1:
+        raise ValueError("Invalid thread pool size: %s" %
+                         settings['thread_pool_size'])
+
+    # addresses allowed to read /metrics, or '*' for any
+    settings['monitoring_allow'] = xget(cfg.get, 'monitoring', 'allow',
+                                        '127.0.0.1 ::1').split()
+
+    # response cache
+    settings['cache_entries'] = xget(cfg.getint, 'cache', 'entries', 128)
+    settings['cache_entry_size'] = xget(cfg.getint, 'cache', 'entry_size', 8388608)
+
+    # content encodings of responses, in order of preference
+    settings['compression_encodings'] = xget(cfg.get, 'compression', 'encodings',
+                                             'br zstd gzip').split()
+
+    # documents rendered for every new snapshot before it is served
+    settings['warmup_queries'] = xget(cfg.get, 'warmup', 'queries', '').split()
     return settings
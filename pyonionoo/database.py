@@ -1,288 +1,290 @@
-import datetime
 import logging
 import os
-import sqlite3
-import threading
 import time
 
-from pyonionoo.parser import Router
-
-# Name of the SQLite database.  This should be defined in a configuration file
-# somewhere.  And it should be ':memory:', not a file.  BUT:  it seems that
-# (1) sqlite3.Connection objects are not thread-safe, and (2) if different
-# threads connect() to ':memory:', they each get their own in-memory database.
-# We don't know how to fix this yet, but it must be possible.
-# Thread-safety is relevant here, because each request should be handled
-# in its own thread so the application doesn't block while processing
-# a single request.  Asynchronous handlers (a la twisted and cyclone) don't
-# really seem to do the job, because we cannot incrementally return
-# a JSON object; we need all of the data in order to construct the
-# JSON object, and so these requests are inherently synchronous.
-DBNAME = 'summary.db'
-
-# Time at which we created the sqlite database from the summary file.
-DB_CREATION_TIME = -1
+from pyonionoo import monitoring
+from pyonionoo.snapshot import build_snapshot, new_generation
+from pyonionoo.snapshotfile import MappedSnapshot, get_file_identity, \
+        write_snapshot
 
-# Interval (in seconds) that we check to update the database.  See
-# freshen_database().
-DB_UPDATE_INTERVAL = 60
-
-# The timer object used for updating the database.
-FRESHEN_TIMER = None
-
-# Database schemas.
-# Summary database:  in conjunction with addresses and flags, holds the
-# information in the summary document.  addresses and flags are lists of
-# IP addresses and flags, respectively.  In order to support searching
-# by these entries, we put them in separate tables, linked by id.
-# Note that as per the SQLite documentation, the id field of summary_schema
-# will be made into an alias for rowid.
-summary_tbl_name = 'summary'
-summary_schema = """
-id INTEGER PRIMARY KEY,
-type TEXT,
-nickname TEXT,
-fingerprint,
-hashed_fingerprint,
-running BOOLEAN,
-time_published TEXT,
-or_port TEXT,
-dir_port TEXT,
-consensus_weight INTEGER,
-country_code TEXT collate NOCASE,
-hostname TEXT,
-time_lookup TEXT,
-flags TEXT,
-addresses TEXT,
-search TEXT collate NOCASE,
-lookup TEXT collate NOCASE
-"""
-
-def _create_table(conn, tbl_name, schema):
-    """
-    Create a database table; drop a table by the same name if it already
-    exists.  This function does not commit the table creation instructions.
+# The current snapshot of the summary document.  Request threads only ever
+# read this reference; update_databases() builds a complete new Snapshot
+# and then rebinds it, which is atomic, so readers never see a partially
+# updated set of routers and never need to take a lock.  Each request
+# should read SNAPSHOT once and use that object for the whole request.
+SNAPSHOT = None
 
-    @type conn: sqlite3.Connector
-    @param conn:  open database connection.
+# Number of routers inserted, updated, deleted and left unchanged by the
+# last refresh, see snapshot.build_snapshot().
+LAST_CHANGES = None
 
-    @type tbl_name: string
-    @param tbl_name: the name of the database table.
+# Path of the snapshot file to publish every new snapshot to, if this
+# process is the loader of a multi-process setup; see snapshotfile.
+SNAPSHOT_FILE = None
 
-    @type schema: string
-    @param schema: the SQLite schema for the table.
-    """
+# Directory of the details documents, if any; see details.build_details().
+DETAILS_DIR = None
 
-    cursor = conn.cursor()
+# Directory of the bandwidth files, if any; see bandwidth.build_bandwidth().
+BANDWIDTH_DIR = None
+
+# Time at which the current snapshot started being served.
+SNAPSHOT_TIME = None
+
+# Modification time of the summary file the current snapshot was built
+# from.  Refreshes are scheduled by watcher.SummaryWatcher.
+DB_CREATION_TIME = -1
 
-    logging.info("Creating table %s" % (tbl_name))
-    # Can only use placeholders in select statements?
-    cursor.execute('DROP TABLE IF EXISTS %s' % tbl_name)
-    cursor.execute('CREATE TABLE %s (%s)' % (tbl_name, schema))
-    logging.info("Created table %s" % (tbl_name))
+# Function called with every new snapshot in the refresh thread, before
+# the snapshot is served; see warmup.WarmUp.
+WARM_UP = None
 
-def bootstrap_database(metrics_out, summary_file):
+def bootstrap_database(metrics_out, summary_file, snapshot_file=None,
+                       details_dir=None, bandwidth_dir=None):
     """
-    Bootstraps the database creation process:
-      * Create 3 databases - summary, flags, addresses
-      * Updates the databases
+    Bootstraps the database creation process by building the first
+    snapshot from the summary file.
 
     @type metrics_out: string
     @param metrics_out: path to metrics data dir
 
     @type summary_file: string
     @param summary_file: summary file name
+
+    @type snapshot_file: string
+    @param snapshot_file: if given, path of the snapshot file that every
+        new snapshot is published to for worker processes.
+
+    @type details_dir: string
+    @param details_dir: if given, name of the details documents dir in
+        metrics_out.
+
+    @type bandwidth_dir: string
+    @param bandwidth_dir: if given, name of the bandwidth files dir in
+        metrics_out.
     """
+    global SNAPSHOT_FILE, DETAILS_DIR, BANDWIDTH_DIR
 
     summary_file = os.path.join(metrics_out, summary_file)
+    SNAPSHOT_FILE = snapshot_file
+    if details_dir:
+        DETAILS_DIR = os.path.join(metrics_out, details_dir)
+    if bandwidth_dir:
+        BANDWIDTH_DIR = os.path.join(metrics_out, bandwidth_dir)
 
-    conn = get_database_conn()
+    update_databases(summary_file)
 
-    # Create the tables.
-    _create_table(conn, summary_tbl_name, summary_schema)
+def load_snapshot(snapshot_file):
+    """
+    Serve requests from the snapshot published in a snapshot file by the
+    loader process, unless the current snapshot was mapped from that very
+    file.  Every published file is loaded, whatever its generation, so
+    that a restarted loader is followed too.
 
-    conn.commit()
+    @type snapshot_file: string
+    @param snapshot_file: path of the snapshot file.
+    """
+    global SNAPSHOT, SNAPSHOT_TIME
 
-    update_databases(summary_file)
+    if SNAPSHOT and getattr(SNAPSHOT, 'file_identity', None) == \
+            get_file_identity(snapshot_file):
+        return
+
+    start = time.time()
+    snapshot = MappedSnapshot(snapshot_file)
+    if WARM_UP:
+        WARM_UP(snapshot)
+    SNAPSHOT = snapshot
+    SNAPSHOT_TIME = time.time()
+    monitoring.REFRESH_SECONDS.observe(SNAPSHOT_TIME - start)
+    logging.info("Mapped snapshot generation %d (%d routers)" %
+                 (snapshot.generation, snapshot.size))
 
 def update_databases(summary_file=None):
     """
     Updates the database.
 
-    This operation operates as a single transaction.  Therefore,
-    the database can be read by other requests while it is being
-    performed, and those reads will correspond to the "un-updated"
-    database.  Once this function completes, all future reads will be
-    from the "updated" database.
+    The new snapshot is built completely before it replaces the current
+    one.  Therefore, requests can be served from the current snapshot
+    while the update is being performed.  Once this function completes,
+    all future reads will be from the new snapshot.
 
     @type summary_file: string
     @param summary_file: full path to the summary file
     """
-    global DB_CREATION_TIME
-
-    if DB_CREATION_TIME >= os.stat(summary_file).st_mtime:
-        return
-
-    logging.info("Updating database")
-
-    # It seems that the default isolation_level is probably OK for
-    # all of this to be done in a single transaction.
-    conn = get_database_conn()
-
-    # First delete all records.
-    logging.info("Deleting data from databases")
-    CURSOR = conn.cursor()
-    CURSOR.execute('DELETE FROM %s' % summary_tbl_name)
-
-    # Create the summary database.  We could accumulate all the router tuples
-    # and then insert them with an executemany(...) in one go, except that
-    # makes it more time consuming to create the flags and addresses tables.
-    # In effect, to create those tables, we would have to query summary
-    # for each relay fingerprint in order to get the id of the row in
-    # summary for that fingerprint, in order to set the corresopnding id
-    # field in the flags/addresses table.  Here we can avoid all those
-    # selects, because the rowid attribute of the cursor is set to that
-    # id field right after we execute the (individual) insert statements.
-    summary_fields = ('type', 'nickname', 'fingerprint', 'hashed_fingerprint', 'running',
-                      'time_published', 'or_port', 'dir_port', 'consensus_weight',
-                      'country_code', 'hostname', 'time_lookup', 'flags', 'addresses',
-                      'search', 'lookup')
-
-    insert_stmt = 'insert into %s (%s) values (%s)'
-
-    # create insertion statement for summary table
-    summary_insert_stmt = (insert_stmt % (summary_tbl_name, ','.join(summary_fields),
-                                          ','.join(['?']*len(summary_fields))))
+    global DB_CREATION_TIME, SNAPSHOT, SNAPSHOT_TIME, LAST_CHANGES
 
     if not summary_file:
         # raise Exception?
         return
 
-    with open(summary_file) as f:
-        for line in f.readlines():
-            router = Router()
-            router.parse(line)
+    # Record the modification time before reading, so that a file that is
+    # rewritten while we read it is picked up by the next refresh.
+    mtime = os.stat(summary_file).st_mtime
+    if DB_CREATION_TIME >= mtime:
+        return
 
-            router_tuple = router.get_router_tuple(summary_fields)
+    logging.info("Updating database")
 
-            # TODO: Determine whether sqlite3 optimizes by remembering
-            # this insert command and not parsing it every time it sees
-            # it.  This is mentioned in PEP 249, but we aren't sure where
-            # the PEP says that implementations might optimize in this way,
-            # or might allow users to optimize in this way.
-            CURSOR.execute(summary_insert_stmt, router_tuple)
-            id_num = CURSOR.lastrowid
+    start = time.time()
+    generation = new_generation(SNAPSHOT)
+    with open(summary_file) as f:
+        snapshot, changes = build_snapshot(f, generation, SNAPSHOT,
+                                           DETAILS_DIR, BANDWIDTH_DIR, mtime)
+    elapsed = time.time() - start
+    logging.info("Ingested %d routers in %.3f s (%d rows/s): %d inserted, "
+                 "%d updated, %d deleted, %d unchanged, %d details updated, "
+                 "%d bandwidth histories updated" %
+                 (snapshot.size, elapsed, snapshot.size / max(elapsed, 1e-6),
+                  changes['inserted'], changes['updated'], changes['deleted'],
+                  changes['unchanged'], changes['details'],
+                  changes['bandwidth']))
+    monitoring.REFRESH_SECONDS.observe(elapsed)
+    for change, count in changes.iteritems():
+        monitoring.REFRESH_ROUTERS.inc(count, change)
+
+    LAST_CHANGES = changes
+    if snapshot is not SNAPSHOT:
+        if WARM_UP:
+            WARM_UP(snapshot)
+        SNAPSHOT = snapshot
+        SNAPSHOT_TIME = time.time()
+        logging.info("Table updated")
+        if SNAPSHOT_FILE:
+            write_snapshot(snapshot, SNAPSHOT_FILE)
+            logging.info("Published snapshot to %s" % SNAPSHOT_FILE)
+    DB_CREATION_TIME = mtime
 
-    conn.commit()
-    logging.info("Table updated")
-    DB_CREATION_TIME = time.time()
+def query_summary_tbl(running_filter=None, type_filter=None, lookup_filter=None,
+                      country_filter=None, search_filter=None, order_fields=None,
+                      offset_value=None, limit_value=None, cursor=None,
+                      fields=('fingerprint',), snapshot=None):
+    """
+    Get the values of the given fields for all routers matching the
+    request parameters.
 
-    FRESHEN_TIMER = threading.Timer(DB_UPDATE_INTERVAL, update_databases, [summary_file])
-    FRESHEN_TIMER.start()
+    @type snapshot: Snapshot
+    @param snapshot: snapshot to query; the current one if None.
 
-def cancel_freshen():
-    FRESHEN_TIMER.cancel()
+    @rtype: list of tuple
+    @return: one tuple of values per matching router, in the order of fields.
+    """
 
-def get_database_conn():
-    conn = sqlite3.connect(DBNAME)
-    return conn
+    snapshot = snapshot or SNAPSHOT
+    rows = snapshot.select(running_filter, type_filter, lookup_filter,
+                           country_filter, search_filter, order_fields,
+                           offset_value, limit_value, cursor)
+    return snapshot.get_rows(rows, fields)
 
-def query_summary_tbl(running_filter=None, type_filter=None, lookup_filter=None,
-                      country_filter=None, search_filter=None, order_field=None,
-                      order_asc=True, offset_value=None, limit_value=None,
-                      fields=('fingerprint',)):
-    conn = get_database_conn()
-    cursor = conn.cursor()
-    # Build up a WHERE clause based on the request parameters.  We only
-    # consider the case in which the client specifies 'search' or
-    # some subset (possibly empty) of {'running', 'type', 'lookup', 'country'}.
-    clauses = []
-    if search_filter:
-        for search_string in search_filter:
-            if search_string[0] == '$':
-                search_string = ''.join(search_string[1:])
-            clauses.append("search like '%% %s%%'" % search_string)
-    if running_filter:
-        clauses.append("running = %s" % int(running_filter))
-    if type_filter:
-        clauses.append("type = '%s'" % type_filter)
-    if lookup_filter:
-        clauses.append("lookup like '%% %s%%'" % lookup_filter)
-    if country_filter:
-        clauses.append("country_code = '%s'" % country_filter)
-    where_clause = ('WHERE %s' % ' and '.join(clauses)) if clauses else ''
-
-    # Construct the ORDER, LIMIT, and OFFSET clauses.
-    order_clause = ''
-    if order_field:
-        order_clause = 'ORDER BY %s %s' % (order_field,
-                                           'ASC' if order_asc else 'DESC')
-    limit_clause = ''
-    if limit_value:
-        limit_clause = 'LIMIT %s' % limit_value
-    offset_clause = ''
-    if offset_value:
-        if not limit_value:
-            # sqlite doesn't support OFFSET without a LIMIT clause, this is
-            # a hack to get around that.
-            limit_clause = 'LIMIT -1'
-        offset_clause = 'OFFSET %s' % offset_value
-    cursor.execute('SELECT %s FROM summary %s %s %s %s' %
-                   (','.join(fields), where_clause, order_clause, limit_clause,
-                    offset_clause))
-
-    return cursor.fetchall()
-
-def get_timestamp():
+def get_timestamp(snapshot=None):
     """
     Get the latest known published timestamp of relay consensus and network
     consensus document
 
+    @type snapshot: Snapshot
+    @param snapshot: snapshot to query; the current one if None.
+
     @rtype: tuple
     @return: (relay_timestamp, bridge_timestamp) where
-             relays_timestamp, bridges_timestamp is a datetime object
+             relays_timestamp, bridges_timestamp is a datetime object, or
+             None if the snapshot has no relays or no bridges.  They are
+             read from the snapshot metadata, see snapshot.Metadata.
     """
 
-    relay_timestamp, bridge_timestamp = None, None
-    conn = get_database_conn()
-    cursor = conn.cursor()
+    metadata = (snapshot or SNAPSHOT).metadata
+    return (metadata.relays_published, metadata.bridges_published)
 
-    cursor.execute('SELECT MAX(time_published) FROM summary WHERE type="r"')
-    relay_timestamp = datetime.datetime.strptime(cursor.fetchone()[0], "%Y-%m-%d %H:%M:%S")
+def get_summary_rows(running_filter=None, type_filter=None, lookup_filter=None,
+                     country_filter=None, search_filter=None, order_fields=None,
+                     offset_value=None, limit_value=None, cursor=None,
+                     snapshot=None):
+    """
+    Like get_summary_routers(), but without materializing Router objects:
+    routers are returned as row indexes into the snapshot columns.
+
+    @type snapshot: Snapshot
+    @param snapshot: snapshot to query; the current one if None.
 
-    cursor.execute('SELECT MAX(time_published) FROM summary WHERE type="b"')
-    bridge_timestamp = datetime.datetime.strptime(cursor.fetchone()[0], "%Y-%m-%d %H:%M:%S")
+    @rtype: tuple.
+    @return: tuple of form (relays, bridges, relays_time, bridges_time,
+             next_cursor), where
+             * relays/bridges is a list of row indexes into snapshot
+             * relays_timestamp/bridges_timestamp is a datetime object with the most
+               recent timestamp of the relay/bridges descriptors in relays,
+               or None if there are none, see get_timestamp().
+             * next_cursor is the cursor of the next page of results (see
+               Snapshot.get_cursor()), or None if there is no limit or
+               fewer than limit_value routers were returned.
+    """
 
-    return (relay_timestamp, bridge_timestamp)
+    snapshot = snapshot or SNAPSHOT
+    relay_timestamp, bridge_timestamp = get_timestamp(snapshot)
+
+    rows = snapshot.select(running_filter, type_filter, lookup_filter,
+                           country_filter, search_filter, order_fields,
+                           offset_value, limit_value, cursor)
+    relays, bridges = [], []
+    for row in rows:
+        if snapshot.type[row] == 'r': relays.append(row)
+        if snapshot.type[row] == 'b': bridges.append(row)
+
+    next_cursor = None
+    if limit_value and len(rows) == limit_value:
+        next_cursor = snapshot.get_cursor(rows[-1], order_fields)
+
+    return (relays, bridges, relay_timestamp, bridge_timestamp, next_cursor)
+
+def get_aggregates(running_filter=None, type_filter=None, country_filter=None,
+                   group_by=None, snapshot=None):
+    """
+    Get the number of routers and the sum of their consensus weights,
+    grouped by an attribute, from the rollups of the snapshot.
+
+    @type group_by: string
+    @param group_by: attribute to group by, see rollups.GROUP_BY_FIELDS,
+        or None for a single group of all matching routers.
+
+    @type snapshot: Snapshot
+    @param snapshot: snapshot to query; the current one if None.
+
+    @rtype: list of tuple
+    @return: tuples of form (value, count, consensus_weight), see
+             rollups.Rollups.get_groups().
+    """
+
+    snapshot = snapshot or SNAPSHOT
+    return snapshot.rollups.get_groups(snapshot.flags.names, running_filter,
+                                       type_filter, country_filter, group_by)
 
 def get_summary_routers(running_filter=None, type_filter=None, lookup_filter=None,
-                        country_filter=None, search_filter=None, order_field=None,
-                        order_asc=True, offset_value=None, limit_value=None):
+                        country_filter=None, search_filter=None, order_fields=None,
+                        offset_value=None, limit_value=None, cursor=None,
+                        snapshot=None):
     """
     Get summary document according to request parameters.
 
+    @type snapshot: Snapshot
+    @param snapshot: snapshot to query; the current one if None.
+
     @rtype: tuple.
     @return: tuple of form (relays, bridges, relays_time, bridges_time), where
-             * relays/bridges is a list of Router objects
+             * relays/bridges is a list of RouterRow objects
              * relays_timestamp/bridges_timestamp is a datetime object with the most
                recent timestamp of the relay/bridges descriptors in relays.
     """
 
-    relay_timestamp, bridge_timestamp = get_timestamp()
+    # Use the same snapshot for the timestamps and the routers, even if
+    # a refresh replaces it in the meantime.
+    snapshot = snapshot or SNAPSHOT
+    relay_timestamp, bridge_timestamp = get_timestamp(snapshot)
 
     relays, bridges = [], []
-    fields = ('type', 'nickname', 'fingerprint', 'running', 'country_code',
-            'time_published', 'consensus_weight')
-    for row in query_summary_tbl(running_filter, type_filter, lookup_filter,
-                                 country_filter, search_filter,order_field, order_asc,
-                                 offset_value, limit_value, fields):
-        router = Router()
-
-        # This is magic
-        map(lambda (attr, value): setattr(router, attr, value), zip(fields, row))
-
-        if row[0] == 'r': relays.append(router)
-        if row[0] == 'b': bridges.append(router)
+    for row in snapshot.select(running_filter, type_filter, lookup_filter,
+                               country_filter, search_filter, order_fields,
+                               offset_value, limit_value, cursor):
+        router = snapshot.get_router(row)
+        if router.type == 'r': relays.append(router)
+        if router.type == 'b': bridges.append(router)
 
     total_routers = (relays, bridges, relay_timestamp, bridge_timestamp)
     return total_routers
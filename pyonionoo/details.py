@@ -0,0 +1,287 @@
+"""
+Details of routers, from the details documents in the metrics data dir.
+
+The metrics data dir has one details document per router, a JSON object
+named after the router's fingerprint (the hashed fingerprint for
+bridges), with the fields of the router's entry in the details document
+served by /detail.  Each snapshot has a DetailsStore with the fields of
+those documents; fields that a router's document does not have, or all of
+them if it has none, are taken from the summary file columns.
+
+The fields of a document are kept as records of their JSON encodings,
+so that serving a detail entry only splits the records and joins the
+requested fields.  Large fields (LARGE_FIELDS) are kept in a record of
+their own, which is only split if one of them is requested.  Documents
+are only read when a snapshot is built, so every entry served from a
+snapshot is as of that snapshot.
+"""
+
+import array
+import json
+import logging
+import os
+
+from pyonionoo.columns import StringColumn
+from pyonionoo.encoder import encode_string, encode_value
+
+# Fields of detail entries, in output order.  Relay entries have the
+# fingerprint field and bridge entries the hashed_fingerprint field.
+DETAIL_FIELDS = ('nickname', 'fingerprint', 'hashed_fingerprint',
+                 'or_addresses', 'exit_addresses', 'dir_address', 'last_seen',
+                 'first_seen', 'running', 'flags', 'country', 'country_name',
+                 'region_name', 'city_name', 'latitude', 'longitude',
+                 'as_number', 'as_name', 'consensus_weight', 'host_name',
+                 'last_restarted', 'bandwidth_rate', 'bandwidth_burst',
+                 'observed_bandwidth', 'advertised_bandwidth', 'exit_policy',
+                 'exit_policy_summary', 'contact', 'platform', 'family',
+                 'advertised_bandwidth_fraction', 'consensus_weight_fraction',
+                 'guard_probability', 'middle_probability', 'exit_probability',
+                 'pool_assignment')
+
+# Fields that are large and seldom requested, kept in a separate record.
+LARGE_FIELDS = ('exit_policy', 'exit_policy_summary', 'family')
+
+# Fields kept in the main record.
+STORED_FIELDS = tuple(field for field in DETAIL_FIELDS
+                      if field not in LARGE_FIELDS)
+
+# Encoded member names, e.g. '"nickname": '.
+MEMBER_PREFIXES = dict((field, '%s: ' % encode_string(field))
+                       for field in DETAIL_FIELDS)
+
+# Separator of the fields of a record; JSON encodings never contain it.
+FIELD_SEPARATOR = '\x01'
+
+def _encode_list(values):
+    return '[%s]' % ', '.join(encode_string(value) for value in values)
+
+def _encode_or_addresses(snapshot, row):
+    return _encode_list(['%s:%d' % (snapshot.address[row], snapshot.or_port[row])] +
+                        (snapshot.or_addresses[row] or []))
+
+def _encode_fingerprint(snapshot, row):
+    if snapshot.type[row] == 'r':
+        return encode_string(snapshot.fingerprint[row])
+
+def _encode_hashed_fingerprint(snapshot, row):
+    if snapshot.type[row] == 'b':
+        return encode_string(snapshot.fingerprint[row])
+
+def _encode_exit_addresses(snapshot, row):
+    if snapshot.type[row] == 'r' and snapshot.exit_addresses[row]:
+        return _encode_list(snapshot.exit_addresses[row])
+
+def _encode_dir_address(snapshot, row):
+    if snapshot.type[row] == 'r' and snapshot.dir_port[row]:
+        return encode_string('%s:%d' % (snapshot.address[row],
+                                        snapshot.dir_port[row]))
+
+def _encode_country(snapshot, row):
+    if snapshot.type[row] == 'r':
+        return encode_string(snapshot.country_code[row])
+
+def _encode_consensus_weight(snapshot, row):
+    if snapshot.type[row] == 'r':
+        return str(snapshot.consensus_weight[row])
+
+def _encode_host_name(snapshot, row):
+    if snapshot.type[row] == 'r' and snapshot.hostname[row]:
+        return encode_string(snapshot.hostname[row])
+
+# Functions returning the JSON encoding of a detail field of the router
+# in a row, as far as the summary file tells about it, or None.
+SUMMARY_ENCODERS = {
+    'nickname': lambda snapshot, row: encode_string(snapshot.nickname[row]),
+    'fingerprint': _encode_fingerprint,
+    'hashed_fingerprint': _encode_hashed_fingerprint,
+    'or_addresses': _encode_or_addresses,
+    'exit_addresses': _encode_exit_addresses,
+    'dir_address': _encode_dir_address,
+    'last_seen': lambda snapshot, row: encode_string(
+            snapshot.time_published[row].strftime("%Y-%m-%d %H:%M:%S")),
+    'running': lambda snapshot, row: 'true' if snapshot.running[row] else 'false',
+    'flags': lambda snapshot, row: _encode_list(snapshot.flags[row]),
+    'country': _encode_country,
+    'consensus_weight': _encode_consensus_weight,
+    'host_name': _encode_host_name
+}
+
+def read_document(details_dir, fingerprint):
+    """
+    @type details_dir: string
+    @param details_dir: directory of the details documents, or None.
+
+    @type fingerprint: string
+    @param fingerprint: fingerprint of a relay or hashed fingerprint of a
+        bridge.
+
+    @rtype: dict
+    @return: details document of the router, or None if it has none or
+        it cannot be read.
+    """
+
+    if not details_dir:
+        return None
+    path = os.path.join(details_dir, fingerprint)
+    try:
+        with open(path) as f:
+            document = json.load(f)
+    except IOError:
+        return None
+    except ValueError, e:
+        logging.error("Invalid details document %s: %s" % (path, e))
+        return None
+    return document if isinstance(document, dict) else None
+
+def _encode_record(document, fields):
+    return FIELD_SEPARATOR.join(
+            encode_value(document[field]) if document.get(field) is not None
+            else '' for field in fields)
+
+def build_details(snapshot, details_dir, previous=None, kept=None):
+    """
+    Build the details of the routers of a snapshot.
+
+    The record of a router is taken over from previous if neither its
+    summary file line nor its details document have changed; only the
+    other details documents are read.
+
+    @type snapshot: Snapshot
+    @param snapshot: snapshot to build the details of.
+
+    @type details_dir: string
+    @param details_dir: directory of the details documents, or None to
+        only use the summary file.
+
+    @type previous: Snapshot
+    @param previous: previous snapshot, or None.
+
+    @type kept: list
+    @param kept: for each row of snapshot, its row in previous if its
+        summary file line is unchanged, or None.
+
+    @rtype: tuple
+    @return: tuple of form (details, changed), where details is the
+        DetailsStore and changed the number of routers whose record was
+        not taken over from previous, not counting routers that have no
+        details document and had none in previous.
+    """
+
+    previous_details = getattr(previous, 'details', None)
+    if previous_details is None or previous_details.details_dir != details_dir:
+        kept = None
+    if details_dir and not os.path.isdir(details_dir):
+        logging.error("Details directory %s not found" % details_dir)
+        details_dir = None
+
+    records, large_records = [], []
+    mtimes = array.array('d')
+    changed = 0
+    for row in xrange(snapshot.size):
+        fingerprint = snapshot.fingerprint[row]
+        mtime = -1
+        if details_dir:
+            try:
+                mtime = os.stat(os.path.join(details_dir, fingerprint)).st_mtime
+            except OSError:
+                pass
+        mtimes.append(mtime)
+
+        previous_row = kept[row] if kept is not None else None
+        previous_mtime = -1
+        if previous_row is not None:
+            previous_mtime = previous_details.mtimes[previous_row]
+            if previous_mtime == mtime:
+                records.append(previous_details.records[previous_row])
+                large_records.append(
+                        previous_details.large_records[previous_row])
+                continue
+
+        # Routers that have no details document, and had none before,
+        # have no details to update.
+        if mtime != -1 or previous_mtime != -1:
+            changed += 1
+        if mtime == -1:
+            records.append(None)
+            large_records.append(None)
+            continue
+        document = read_document(details_dir, fingerprint) or {}
+        records.append(_encode_record(document, STORED_FIELDS))
+        large_records.append(_encode_record(document, LARGE_FIELDS))
+
+    details = DetailsStore(details_dir,
+                           StringColumn(StringColumn.encode(records), 0,
+                                        snapshot.size),
+                           StringColumn(StringColumn.encode(large_records), 0,
+                                        snapshot.size),
+                           mtimes)
+    return details, changed
+
+class DetailsStore(object):
+    def __init__(self, details_dir, records, large_records, mtimes):
+        """
+        @type details_dir: string
+        @param details_dir: directory of the details documents, or None.
+
+        @type records: sequence of string
+        @param records: for every row, the JSON encodings of the fields in
+            STORED_FIELDS of its details document, joined with
+            FIELD_SEPARATOR (empty if the document does not have the
+            field), or None if it has no details document.
+
+        @type large_records: sequence of string
+        @param large_records: the same for the fields in LARGE_FIELDS.
+
+        @type mtimes: sequence of float
+        @param mtimes: modification time of the details document of every
+            row, or -1 if it has none.
+        """
+
+        self.details_dir = details_dir
+        self.records = records
+        self.large_records = large_records
+        self.mtimes = mtimes
+
+    def iter_entries(self, snapshot, rows, fields=None):
+        """
+        @type snapshot: Snapshot
+        @param snapshot: snapshot that this store belongs to.
+
+        @type rows: iterable of int
+        @param rows: rows to get the detail entries of.
+
+        @type fields: tuple of string
+        @param fields: fields to include, in DETAIL_FIELDS order; all of
+            them if None.
+
+        @rtype: iterator of string
+        @return: the JSON encoded detail entry of every row.
+        """
+
+        fields = fields or DETAIL_FIELDS
+        positions = dict((field, (0, position))
+                         for position, field in enumerate(STORED_FIELDS))
+        positions.update((field, (1, position))
+                         for position, field in enumerate(LARGE_FIELDS))
+        members = [(MEMBER_PREFIXES[field],) + positions[field] +
+                   (SUMMARY_ENCODERS.get(field),)
+                   for field in fields]
+        # Only split the records that requested fields are in.
+        records = [(index, column) for index, column
+                   in enumerate((self.records, self.large_records))
+                   if any(positions[field][0] == index for field in fields)]
+        for row in rows:
+            values = [None, None]
+            for index, column in records:
+                record = column[row]
+                if record is not None:
+                    values[index] = record.split(FIELD_SEPARATOR)
+            parts = []
+            for prefix, index, position, encode_summary in members:
+                value = values[index][position] or None \
+                        if values[index] is not None else None
+                if value is None and encode_summary is not None:
+                    value = encode_summary(snapshot, row)
+                if value is not None:
+                    parts.append(prefix + value)
+            yield '{' + ', '.join(parts) + '}'
@@ -0,0 +1,122 @@
+"""
+Incremental JSON encoding of response documents.
+
+Documents are JSON objects whose large members are arrays of routers.
+Instead of building the whole document as Python objects and encoding
+it in one go, iter_document() yields the encoded document in chunks of
+a bounded number of array elements, so that it can be written to the
+client with chunked transfer encoding while it is being produced.
+"""
+
+import itertools
+import json
+
+import cyclone.escape
+
+# Maximum number of array elements per chunk of encoded output.
+ELEMENTS_PER_CHUNK = 1000
+
+class EncodedArray(object):
+    """
+    Array member of a document, given as an iterable of already encoded
+    elements.
+    """
+
+    def __init__(self, elements):
+        self.elements = elements
+
+def encode_string(value):
+    """
+    Encode a string the same way as cyclone.escape.json_encode(), but
+    without its generic type dispatching, which dominates the cost of
+    encoding the short strings found in router attributes.
+
+    @type value: string
+    @param value: UTF-8 encoded or unicode string.
+
+    @rtype: string
+    @return: JSON encoding of value.
+    """
+
+    return json.encoder.encode_basestring_ascii(value).replace("</", "<\\/")
+
+def encode_value(value):
+    """
+    Encode a value decoded from JSON the same way as
+    cyclone.escape.json_encode().  Such values have no byte strings, so
+    cyclone's conversion of byte strings to unicode can be skipped.
+
+    @rtype: string
+    @return: JSON encoding of value.
+    """
+
+    return json.dumps(value).replace("</", "<\\/")
+
+def format_timestamp(timestamp):
+    """
+    @type timestamp: datetime
+    @param timestamp: publication time, or None.
+
+    @rtype: string
+    @return: timestamp as written in documents, or None if timestamp is
+        None, which is encoded as null.
+    """
+
+    if timestamp is None:
+        return None
+    return timestamp.strftime("%Y-%m-%d %H:%M:%S")
+
+def encode_summary_router(nickname, fingerprint, running):
+    """
+    @rtype: string
+    @return: JSON encoding of the summary document entry for a router.
+        Snapshots keep this encoding of each of their routers in
+        Snapshot.summary_fragments.
+    """
+
+    return '{"n": %s, "f": %s, "r": %s}' % (
+        encode_string(nickname), encode_string(fingerprint),
+        'true' if running else 'false')
+
+def iter_document(members, elements_per_chunk=ELEMENTS_PER_CHUNK):
+    """
+    Encode a JSON object incrementally.
+
+    @type members: list of (string, object) tuples
+    @param members: names and values of the members of the object, in
+        output order.  Values are either EncodedArray instances or
+        objects that cyclone.escape.json_encode() can encode.
+
+    @type elements_per_chunk: int
+    @param elements_per_chunk: number of array elements after which the
+        output accumulated so far is yielded.
+
+    @rtype: iterator of string
+    @return: consecutive parts of the encoded document.
+    """
+
+    parts = ['{']
+    for index, (name, value) in enumerate(members):
+        if index:
+            parts.append(', ')
+        parts.append('%s: ' % cyclone.escape.json_encode(name))
+        if not isinstance(value, EncodedArray):
+            parts.append(cyclone.escape.json_encode(value))
+            continue
+
+        parts.append('[')
+        elements = iter(value.elements)
+        separator = ''
+        while True:
+            block = list(itertools.islice(elements, elements_per_chunk))
+            if not block:
+                break
+            parts.append(separator)
+            parts.append(', '.join(block))
+            separator = ', '
+            if len(block) == elements_per_chunk:
+                yield ''.join(parts)
+                parts = []
+        parts.append(']')
+    parts.append('}')
+    yield ''.join(parts)
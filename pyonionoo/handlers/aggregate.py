@@ -0,0 +1,35 @@
+import pyonionoo.database as database
+import pyonionoo.encoder as encoder
+from pyonionoo.handlers.base import BaseHandler
+from pyonionoo.rollups import encode_group
+
+ARGUMENTS = ['type', 'running', 'country', 'group_by', 'metric']
+
+class AggregateHandler(BaseHandler):
+    allowed_arguments = ARGUMENTS
+
+    @staticmethod
+    def get_document(parsed_arguments, snapshot):
+        """
+        The document has the number of routers matching the running, type
+        and country parameters, grouped by the group_by parameter, and the
+        sum of the metric parameter, if given, over each group.
+
+        @rtype: iterator of string
+        @return: consecutive parts of the encoded aggregate document.
+        """
+        group_by = parsed_arguments['group_by']
+        metric = parsed_arguments['metric']
+        groups = database.get_aggregates(parsed_arguments['running_filter'],
+                                         parsed_arguments['type_filter'],
+                                         parsed_arguments['country_filter'],
+                                         group_by, snapshot)
+        relay_timestamp, bridge_timestamp = database.get_timestamp(snapshot)
+
+        members = [
+            ('relays_published', encoder.format_timestamp(relay_timestamp)),
+            ('bridges_published', encoder.format_timestamp(bridge_timestamp)),
+            ('groups', encoder.EncodedArray(
+                    encode_group(group_by, metric, group) for group in groups))
+        ]
+        return encoder.iter_document(members)
@@ -4,21 +4,53 @@ Handle URL request parameters.  Provides the following functions:
 parse:  given a GET request parameter dictionary, return a keyword
         argument dictionary suitable for use by the database module
         functions.
+
+normalize:  given a keyword argument dictionary returned by parse,
+        return a hashable key that is the same for all requests with
+        the same results.
+
+encode_cursor, check_cursor:  turn the position after a page of results
+        into the opaque value of the cursor parameter, and check that a
+        parsed cursor can be used with a snapshot.
 """
 
+import base64
+import json
+
 import cyclone.web
 
+from pyonionoo.bandwidth import GRAPH_NAMES
+from pyonionoo.details import DETAIL_FIELDS
+from pyonionoo.rollups import GROUP_BY_FIELDS, METRICS
+
 # Request parameters.
-ARGUMENTS = ['type', 'running', 'search', 'lookup', 'country', 'order', 'offset', 'limit']
+ARGUMENTS = ['type', 'running', 'search', 'lookup', 'country', 'order', 'offset',
+             'limit', 'cursor']
+
+# Maximum number of fingerprints in the lookup parameter.
+MAX_LOOKUPS = 1000
+
+# Fields that results can be ordered by, and the snapshot column that each
+# of them orders by; see snapshot.SORT_COLUMNS.
+ORDER_FIELDS = {
+    'consensus_weight': 'consensus_weight',
+    'nickname': 'nickname',
+    'country': 'country_code_lower'
+}
 
-def parse(arguments):
+def parse(arguments, allowed=ARGUMENTS):
     """
     @type arguments: dict of string -> list of string.
     @param arguments:  dictionary mapping GET request parameters to valuse.
 
+    @type allowed: list of string
+    @param allowed: request parameters that the handler accepts.
+
     @rtype: dict
     @return: dictionary suitable for use for keyword arguments for
-        database module functions.
+        database module functions.  If the fields, graphs, group_by or
+        metric parameters are allowed, it also has a key of that name,
+        which the handler must remove.
     """
 
     # These variables will be assigned non-None values if there is a
@@ -31,17 +63,25 @@ def parse(arguments):
     search_filter = None
 
     # Ordering offset and limit.
-    order_field = None
-    order_asc = True
+    order_fields = None
     offset_value = None
     limit_value = None
+    cursor = None
+
+    # Fields of detail entries and graphs of bandwidth entries.
+    fields = None
+    graphs = None
+
+    # Grouping and summed value of aggregates.
+    group_by = None
+    metric = None
 
     # Parse request arguments.
     # TODO:  If a user submits a request with, e.g., two values for running
     # (a boolean flag), what should we do?  Right now we just use the first
     # argument.
     for key, values in arguments.iteritems():
-        if key in ARGUMENTS:
+        if key in allowed:
             value = values[0]
             error_msg = 'Invalid argument to %s parameter: %s' % (key, value)
 
@@ -61,10 +101,15 @@ def parse(arguments):
                 else:
                     raise cyclone.web.HTTPError(400, error_msg)
 
+            # Up to MAX_LOOKUPS fingerprints, given as repeated parameters
+            # (for instance in the body of a POST request) or
+            # comma-separated.
             elif key == "lookup":
-                if len(value) == 40:
-                    lookup_filter = value
-                else:
+                lookup_filter = tuple(fingerprint for value in values
+                                      for fingerprint in value.split(','))
+                if len(lookup_filter) > MAX_LOOKUPS or \
+                        any(len(fingerprint) != 40
+                            for fingerprint in lookup_filter):
                     raise cyclone.web.HTTPError(400, error_msg)
 
             elif key == "country":
@@ -79,17 +124,17 @@ def parse(arguments):
                 else:
                     raise cyclone.web.HTTPError(400, error_msg)
 
-            # TODO:  Handle list of ordering fields.
-            # This is pretty borked.
+            # A comma-separated list of fields, each of them optionally
+            # prefixed with '-' for descending order.
             elif key == "order":
-                value = value.split()
-                order_asc = (value[0] != '-')
-                if value[0] == '-':
-                    value = value[1:]
-                if value == "consensus_weight":
-                    order_field = 'consensus_weight'
-                else:
-                    raise cyclone.web.HTTPError(400, error_msg)
+                order_fields = []
+                for field in value.split(','):
+                    ascending = not field.startswith('-')
+                    column = ORDER_FIELDS.get(field if ascending else field[1:])
+                    if column is None or column in dict(order_fields):
+                        raise cyclone.web.HTTPError(400, error_msg)
+                    order_fields.append((column, ascending))
+                order_fields = tuple(order_fields)
 
             elif key == 'offset':
                 try:
@@ -103,20 +148,144 @@ def parse(arguments):
                 except ValueError:
                     raise cyclone.web.HTTPError(400, error_msg)
 
-        # key not in ARGUMENTS
+            elif key == 'cursor':
+                cursor = decode_cursor(value)
+                if cursor is None:
+                    raise cyclone.web.HTTPError(400, error_msg)
+
+            elif key == 'fields':
+                fields = set(value.split(','))
+                if not fields.issubset(DETAIL_FIELDS):
+                    raise cyclone.web.HTTPError(400, error_msg)
+                fields = tuple(field for field in DETAIL_FIELDS
+                               if field in fields)
+
+            elif key == 'graphs':
+                graphs = set(value.split(','))
+                if not graphs.issubset(GRAPH_NAMES):
+                    raise cyclone.web.HTTPError(400, error_msg)
+                graphs = tuple(graph for graph in GRAPH_NAMES
+                               if graph in graphs)
+
+            elif key == 'group_by':
+                if value in GROUP_BY_FIELDS:
+                    group_by = value
+                else:
+                    raise cyclone.web.HTTPError(400, error_msg)
+
+            elif key == 'metric':
+                if value in METRICS:
+                    metric = value
+                else:
+                    raise cyclone.web.HTTPError(400, error_msg)
+
+        # key not in allowed
         else:
-            error_msg = 'Invalid request parameter: %s' % value
+            error_msg = 'Invalid request parameter: %s' % key
             raise cyclone.web.HTTPError(400, error_msg)
 
     # There must be a better way to do this...
-    return {
+    parsed_arguments = {
         'running_filter' : running_filter,
         'type_filter' : type_filter,
         'lookup_filter' : lookup_filter,
         'country_filter' : country_filter,
         'search_filter' : search_filter,
-        'order_field' : order_field,
-        'order_asc' : order_asc,
+        'order_fields' : order_fields,
         'offset_value' : offset_value,
-        'limit_value' : limit_value
+        'limit_value' : limit_value,
+        'cursor' : cursor
     }
+    if 'fields' in allowed:
+        parsed_arguments['fields'] = fields
+    if 'graphs' in allowed:
+        parsed_arguments['graphs'] = graphs
+    if 'group_by' in allowed:
+        parsed_arguments['group_by'] = group_by
+    if 'metric' in allowed:
+        parsed_arguments['metric'] = metric
+    return parsed_arguments
+
+def normalize(parsed_arguments):
+    """
+    @type parsed_arguments: dict
+    @param parsed_arguments: dictionary returned by parse().
+
+    @rtype: tuple
+    @return: canonical, hashable form of parsed_arguments.  Filters are
+        matched case-insensitively, so they are lower-cased, and the order
+        of search terms and fingerprints does not matter.
+    """
+
+    key = []
+    for name, value in sorted(parsed_arguments.iteritems()):
+        if value is None:
+            continue
+        if name == 'search_filter':
+            value = tuple(sorted(set((term[1:] if term[0] == '$' else term).lower()
+                                     for term in value)))
+        elif name == 'lookup_filter':
+            value = tuple(sorted(set(fingerprint.lower() for fingerprint in value)))
+        elif name == 'country_filter':
+            value = value.lower()
+        key.append((name, value))
+    return tuple(key)
+
+def encode_cursor(cursor):
+    """
+    @type cursor: tuple
+    @param cursor: position returned by snapshot.Snapshot.get_cursor().
+
+    @rtype: string
+    @return: value of the cursor parameter for the page after cursor.
+    """
+
+    generation, order_fields, fingerprint, values = cursor
+    return base64.urlsafe_b64encode(json.dumps(
+            [generation, order_fields, fingerprint, values])).rstrip('=')
+
+def decode_cursor(value):
+    """
+    @type value: string
+    @param value: value of the cursor parameter.
+
+    @rtype: tuple
+    @return: the position that value was encoded from, or None if value
+        is not a valid cursor.
+    """
+
+    try:
+        generation, order_fields, fingerprint, values = json.loads(
+                base64.urlsafe_b64decode(str(value) + '=' * (-len(value) % 4)))
+        return (int(generation),
+                tuple((str(column), bool(ascending))
+                      for column, ascending in order_fields),
+                str(fingerprint), tuple(values))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+def check_cursor(parsed_arguments, snapshot):
+    """
+    Check that the cursor of a request, if any, can be used to page
+    through the results of snapshot.  Cursors are only valid for the
+    snapshot that they were created for, so that all pages of results are
+    consistent with each other.
+
+    @type parsed_arguments: dict
+    @param parsed_arguments: dictionary returned by parse().
+
+    @type snapshot: Snapshot
+    @param snapshot: snapshot the response is computed from.
+    """
+
+    cursor = parsed_arguments['cursor']
+    if cursor is None:
+        return
+    generation, order_fields = cursor[:2]
+    if generation != snapshot.generation:
+        raise cyclone.web.HTTPError(
+                410, 'Cursor refers to an older snapshot; start over')
+    if order_fields != (parsed_arguments['order_fields'] or ()) or \
+            snapshot.get_cursor_row(cursor) is None:
+        raise cyclone.web.HTTPError(
+                400, 'Invalid argument to cursor parameter')
@@ -0,0 +1,259 @@
+import email.utils
+import hashlib
+import time
+
+import cyclone.web
+
+from twisted.internet import defer, threads
+
+import pyonionoo.handlers.arguments as arguments
+from pyonionoo import compression, database, monitoring
+
+class BaseHandler(cyclone.web.RequestHandler):
+    # Request parameters that the handler accepts, see arguments.parse().
+    # Handlers with these also have a static get_document() method taking
+    # the parsed arguments and a snapshot, and returning an iterator over
+    # the parts of the encoded document, which get() responds with; see
+    # also warmup.WarmUp.
+    allowed_arguments = ()
+
+    # Data that the documents of the handler are computed from, see
+    # snapshot.Metadata.get_last_modified().
+    modified_by = ('summary',)
+
+    def prepare(self):
+        """
+        Negotiate the content encoding of the response, see
+        compression.negotiate().
+        """
+        encodings = self.settings.get('compression_encodings')
+        self.content_encoding = compression.negotiate(
+                self.request.headers.get("Accept-Encoding"), encodings)
+        if encodings:
+            self.set_header("Vary", "Accept-Encoding")
+
+    @defer.inlineCallbacks
+    def get(self):
+        """
+        Respond to a GET request with the document returned by
+        get_document() for the request parameters.  We construct the
+        response in a different thread to avoid blocking, see
+        write_document().  Conditional requests are answered before doing
+        anything else.
+        """
+        parsed_arguments = self.parse_arguments(self.allowed_arguments)
+        key = arguments.normalize(parsed_arguments)
+        snapshot = database.SNAPSHOT
+        if snapshot is None:
+            # A worker whose loader has not published a snapshot yet.
+            raise cyclone.web.HTTPError(503, 'No snapshot loaded yet')
+        arguments.check_cursor(parsed_arguments, snapshot)
+        if self.check_not_modified(snapshot, key):
+            return
+
+        yield self.write_document(snapshot, key, self.get_document,
+                                  parsed_arguments, snapshot)
+
+    def observe_stage(self, stage, seconds):
+        """
+        Record the time spent in a stage of answering the request, see
+        monitoring.REQUEST_STAGE_SECONDS.
+        """
+        monitoring.REQUEST_STAGE_SECONDS.observe(seconds, self.request.path,
+                                                 stage)
+
+    def parse_arguments(self, allowed):
+        """
+        @rtype: dict
+        @return: the request arguments parsed with arguments.parse().
+        """
+        start = time.time()
+        parsed_arguments = arguments.parse(self.request.arguments, allowed)
+        self.observe_stage('parse', time.time() - start)
+        return parsed_arguments
+
+    def on_finish(self):
+        monitoring.REQUEST_SECONDS.observe(self.request.request_time(),
+                                           self.request.path)
+        monitoring.REQUESTS.inc(1, self.request.path, self.get_status())
+
+    def _call_timed(self, stage, function, *args):
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.observe_stage(stage, time.time() - start)
+
+    @defer.inlineCallbacks
+    def write_document(self, snapshot, key, get_chunks, *args):
+        """
+        Write a JSON document to the client.
+
+        The document is encoded incrementally, one chunk per call in the
+        thread pool, and every chunk is flushed to the client as soon as
+        it is available (using chunked transfer encoding), so neither the
+        routers nor the whole document need to be held in memory.
+
+        Encoded documents are cached per snapshot generation, so requests
+        for the same path with the same normalized arguments are answered
+        from the cache until the next refresh.  If the client accepts a
+        content encoding, documents are compressed at a fast level while
+        they are streamed; documents found in the cache are compressed
+        once at a high level, and that variant is cached as well.
+
+        @type snapshot: Snapshot
+        @param snapshot: snapshot the document is computed from.
+
+        @type key: tuple
+        @param key: normalized request arguments, see arguments.normalize().
+
+        @type get_chunks: callable
+        @param get_chunks: function called with args in the thread pool,
+            returning an iterator over the parts of the encoded document.
+
+        @rtype: Deferred
+        @return: fires once the whole document is written.
+        """
+        cache = self.application.response_cache
+        cache_key = (self.request.path, key)
+        encoding = self.content_encoding
+
+        self.set_header("Content-Type", "application/json")
+        if encoding is not None:
+            response = cache.get(snapshot.generation, cache_key + (encoding,))
+            if response is not None:
+                self.set_header("Content-Encoding", encoding)
+                self._call_timed('write', self.write, response)
+                return
+
+        response = cache.get(snapshot.generation, cache_key)
+        if response is not None:
+            if encoding is not None and len(response) >= compression.MIN_SIZE:
+                response = yield threads.deferToThread(
+                        self._call_timed, 'compress', compression.compress,
+                        response, encoding, compression.LEVELS[encoding][1])
+                cache.put(snapshot.generation, cache_key + (encoding,),
+                          response)
+                self.set_header("Content-Encoding", encoding)
+            self._call_timed('write', self.write, response)
+            return
+
+        chunks = yield threads.deferToThread(self._call_timed, 'query',
+                                             get_chunks, *args)
+
+        # Time spent encoding and compressing chunks, in the thread pool,
+        # and writing them, in the reactor thread.
+        timings = {'encode': 0.0, 'compress': 0.0, 'write': 0.0}
+
+        # Whether the response is compressed is decided on its first
+        # chunk, so that small responses are sent uncompressed.
+        compressors = []
+
+        def next_chunk():
+            start = time.time()
+            chunk = next(chunks, None)
+            timings['encode'] += time.time() - start
+            if chunk is None:
+                return None, None
+            if encoding is not None and not compressors:
+                compressors.append(
+                        compression.get_compressor(
+                                encoding, compression.LEVELS[encoding][0])
+                        if len(chunk) >= compression.MIN_SIZE else None)
+            if not compressors or compressors[0] is None:
+                return chunk, chunk
+            start = time.time()
+            data = compressors[0].compress(chunk)
+            timings['compress'] += time.time() - start
+            return chunk, data
+
+        # Keep the encoded chunks for the cache, unless the response turns
+        # out to be too large to be cached.
+        cached, cached_size = [], 0
+        max_size = self.settings.get('cache_entry_size')
+        chunk, data = yield threads.deferToThread(next_chunk)
+        compressor = compressors[0] if compressors else None
+        if compressor is not None:
+            self.set_header("Content-Encoding", encoding)
+        while chunk is not None:
+            if cached is not None:
+                cached.append(chunk)
+                cached_size += len(chunk)
+                if cached_size > max_size:
+                    cached = None
+
+            following_chunk, following_data = \
+                    yield threads.deferToThread(next_chunk)
+            if following_chunk is None and compressor is not None:
+                start = time.time()
+                data += compressor.flush()
+                timings['compress'] += time.time() - start
+            start = time.time()
+            if data:
+                self.write(data)
+                # Don't flush the last chunk, so that single-chunk responses
+                # are sent with a Content-Length header.
+                if following_chunk is not None:
+                    self.flush()
+            timings['write'] += time.time() - start
+            chunk, data = following_chunk, following_data
+
+        for stage, seconds in timings.iteritems():
+            if stage != 'compress' or compressor is not None:
+                self.observe_stage(stage, seconds)
+        if cached is not None:
+            cache.put(snapshot.generation, cache_key, ''.join(cached))
+
+    def check_not_modified(self, snapshot, key):
+        """
+        Set the ETag and Last-Modified headers of the response and answer
+        conditional requests.  Call this before doing any work for the
+        request:  if it returns True, the status has been set to 304 and
+        the handler should return without writing a body.
+
+        The ETag is derived from the snapshot generation, the normalized
+        request arguments and the content encoding, so it changes with
+        every refresh.  Generations are unique across processes and
+        restarts (see snapshot.new_generation()), so a tag is never reused
+        for different content, not even by another instance.  Last-Modified
+        is the last time that the data in modified_by changed.  As per RFC
+        7232, If-Modified-Since is only considered if the request has no
+        If-None-Match header.
+
+        @type snapshot: Snapshot
+        @param snapshot: snapshot the response is computed from.
+
+        @type key: tuple
+        @param key: normalized request arguments, see arguments.normalize().
+
+        @rtype: bool
+        @return: whether the client's copy of the response is up to date.
+        """
+
+        etag = '"%x-%s%s"' % (snapshot.generation,
+                              hashlib.sha1(repr(key)).hexdigest(),
+                              '-' + self.content_encoding
+                              if self.content_encoding else '')
+        self.set_header("Etag", etag)
+
+        last_modified = snapshot.metadata.get_last_modified(self.modified_by)
+        if last_modified is not None:
+            self.set_header("Last-Modified",
+                            email.utils.formatdate(last_modified, usegmt=True))
+
+        if_none_match = self.request.headers.get("If-None-Match")
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            not_modified = ('*' in tags or etag in tags or
+                            'W/' + etag in tags)
+        elif if_modified_since and last_modified is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            not_modified = (since is not None and
+                            last_modified <= email.utils.mktime_tz(since))
+        else:
+            not_modified = False
+
+        if not_modified:
+            self.set_status(304)
+        return not_modified
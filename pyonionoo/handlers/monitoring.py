@@ -0,0 +1,16 @@
+import cyclone.web
+
+from pyonionoo import monitoring
+
+class MetricsHandler(cyclone.web.RequestHandler):
+    def get(self):
+        """
+        Respond to a GET request with all metrics in the Prometheus text
+        format, if the client's address is allowed to read them.
+        """
+        allowed = self.settings.get('monitoring_allow')
+        if '*' not in allowed and self.request.remote_ip not in allowed:
+            raise cyclone.web.HTTPError(403)
+
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(monitoring.render())
@@ -1,54 +1,38 @@
-import sys
-import datetime
-
-import cyclone.escape
-import cyclone.web
-
-from twisted.internet import threads, defer, reactor
-from twisted.python import log
+import itertools
 
 import pyonionoo.handlers.arguments as arguments
 import pyonionoo.database as database
-from pyonionoo.parser import Router
-
-ARGUMENTS = ['type', 'running', 'search', 'lookup', 'country', 'order', 'offset', 'limit']
+import pyonionoo.encoder as encoder
+from pyonionoo.handlers.base import BaseHandler
 
-class SummaryHandler(cyclone.web.RequestHandler):
-    @defer.inlineCallbacks
-    def get(self):
-        """
-        Respond to a GET request.  We construct the response in a different
-        thread to avoid blocking.  deferToThread returns a Deferred object,
-        which we can yield immediately; Cyclone then knows to invoke get()
-        again when _get_results has finished, and resopnse will be the
-        return value of _get_results (i.e., the dictionary of results).
-        """
-        d = threads.deferToThread(self._get_results)
-        response = yield d
-        self.write(response)
-        
-    def _get_results(self):
-        user_arguments = self.request.arguments
-        routers = database.get_summary_routers(**arguments.parse(user_arguments))
+ARGUMENTS = ['type', 'running', 'search', 'lookup', 'country', 'order', 'offset',
+             'limit', 'cursor']
 
-        response = {}
-        relays, bridges = [], []
-        filtered_relays, filtered_bridges, relay_timestamp, bridge_timestamp = routers
+class SummaryHandler(BaseHandler):
+    allowed_arguments = ARGUMENTS
 
-        for (src, dest) in ((filtered_relays, relays), (filtered_bridges, bridges)):
-            for router in src:
-                dest.append({
-                    'n' : router.nickname,
-                    'f' : router.fingerprint,
-                    'r' : bool(router.running)
-                })
-
-        # response is a dict, so the order is not maintained. should the
-        # values in the response be in a specific order?
-        response['relays'] = relays
-        response['relays_published'] = relay_timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        response['bridges'] = bridges
-        response['bridges_published'] = bridge_timestamp.strftime("%Y-%m-%d %H:%M:%S")
-
-        return response
+    # POST requests take the same parameters, form-encoded in the body, so
+    # that many fingerprints can be looked up in one request.
+    def post(self):
+        return self.get()
 
+    @staticmethod
+    def get_document(parsed_arguments, snapshot):
+        """
+        @rtype: iterator of string
+        @return: consecutive parts of the encoded summary document.
+        """
+        routers = database.get_summary_rows(snapshot=snapshot,
+                                            **parsed_arguments)
+        relays, bridges, relay_timestamp, bridge_timestamp, next_cursor = routers
+
+        fragment = snapshot.summary_fragments.__getitem__
+        members = [
+            ('relays_published', encoder.format_timestamp(relay_timestamp)),
+            ('relays', encoder.EncodedArray(itertools.imap(fragment, relays))),
+            ('bridges_published', encoder.format_timestamp(bridge_timestamp)),
+            ('bridges', encoder.EncodedArray(itertools.imap(fragment, bridges)))
+        ]
+        if next_cursor is not None:
+            members.append(('next_cursor', arguments.encode_cursor(next_cursor)))
+        return encoder.iter_document(members)
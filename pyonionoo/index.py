@@ -0,0 +1,238 @@
+"""
+Indexes over the routers of a snapshot.  Indexes are built once, together
+with the snapshot they belong to, and are read-only afterwards.
+
+Sets of rows are represented as bitmaps:  a (long) integer in which bit i
+is set if row i is a member of the set.  Intersecting sets of rows is a
+single bitwise AND, whatever the number of routers.  To enumerate the
+members of a bitmap, it is first turned into a bit string, in which
+character i is '1' if bit i is set; scanning and counting such a string
+is done in C by str.find() and str.count().
+"""
+
+import bisect
+import itertools
+
+def make_bitmap(rows, size):
+    """
+    @type rows: iterable of int
+    @param rows: rows to set in the bitmap.
+
+    @type size: int
+    @param size: total number of rows.
+
+    @rtype: long
+    @return: bitmap with the bits of rows set.
+    """
+
+    bits = bytearray('0' * size)
+    for row in rows:
+        bits[row] = '1'
+    bits.reverse()
+    return int(str(bits) or '0', 2)
+
+def get_bit_string(bitmap, size):
+    """
+    @type bitmap: long
+    @param bitmap: bitmap of rows.
+
+    @type size: int
+    @param size: total number of rows.
+
+    @rtype: string
+    @return: string of size '0' and '1' characters, character i being
+        '1' if bit i of bitmap is set.
+    """
+
+    bits = bin(bitmap)[:1:-1]
+    return bits + '0' * (size - len(bits))
+
+def get_set_rows(bits, offset_value=None, limit_value=None, start_row=0):
+    """
+    Get the rows set in a bit string, in ascending order.
+
+    @type bits: string
+    @param bits: bit string, as returned by get_bit_string().
+
+    @type offset_value: int
+    @param offset_value: number of set rows to skip.
+
+    @type limit_value: int
+    @param limit_value: maximum number of rows to return.
+
+    @type start_row: int
+    @param start_row: first row to consider.
+
+    @rtype: list of int
+    @return: rows set in bits.
+    """
+
+    # Find the position of the first row to return with a binary search
+    # on the number of set rows before it, instead of walking past the
+    # first offset_value set rows one by one.
+    start = start_row
+    if offset_value:
+        low, high = start_row, len(bits)
+        while low < high:
+            middle = (low + high) // 2
+            if bits.count('1', start_row, middle) < offset_value:
+                low = middle + 1
+            else:
+                high = middle
+        start = low
+
+    rows = []
+    row = bits.find('1', start)
+    while row != -1:
+        if limit_value and len(rows) >= limit_value:
+            break
+        rows.append(row)
+        row = bits.find('1', row + 1)
+    return rows
+
+class BitmapIndex(object):
+    """
+    Index of a low-cardinality column, such as the running flag, the
+    router type or the country code:  one bitmap per distinct value.
+    """
+
+    def __init__(self, values):
+        """
+        @type values: sequence
+        @param values: value of the indexed column for every row.
+        """
+
+        rows = {}
+        for row, value in enumerate(values):
+            rows.setdefault(value, []).append(row)
+        self.bitmaps = dict((value, make_bitmap(value_rows, len(values)))
+                            for value, value_rows in rows.iteritems())
+
+    def get(self, value):
+        """
+        @rtype: long
+        @return: bitmap of the rows having value in the indexed column.
+        """
+
+        return self.bitmaps.get(value, 0)
+
+class SearchIndex(object):
+    """
+    Index for the search and lookup request parameters.
+
+    lookup values are resolved with an exact-match hash from lower-cased
+    fingerprint and hashed fingerprint to row.  search terms are resolved
+    with a sorted list of (token, row) pairs over the lower-cased nickname,
+    fingerprint, hashed fingerprint and address of every router:  all
+    tokens starting with a term are adjacent in that list, so the rows
+    matching a term are found with two binary searches.
+    """
+
+    def __init__(self, search_tokens, previous=None, row_map=None):
+        """
+        @type search_tokens: sequence of tuple of string
+        @param search_tokens: lower-cased search tokens of every row; the
+            first two tokens of a row, its fingerprint and hashed
+            fingerprint, are its lookup tokens.
+
+        @type previous: SearchIndex
+        @param previous: index of the previous snapshot, whose entries are
+            reused for the rows carried over from that snapshot.
+
+        @type row_map: list
+        @param row_map: for each row of the previous snapshot, its row in
+            the new one, or None if it was deleted or changed.
+        """
+
+        # Fingerprints are normally unique, so map tokens to single rows
+        # and only fall back to lists of rows if there are duplicates.
+        keys = [token for tokens in search_tokens for token in tokens[:2]]
+        values = [row for row, tokens in enumerate(search_tokens)
+                  for token in tokens[:2]]
+        self.lookup = dict(itertools.izip(keys, values))
+        if len(self.lookup) != len(keys):
+            self.lookup = {}
+            for key, row in itertools.izip(keys, values):
+                self.lookup.setdefault(key, []).append(row)
+
+        # Sorting positions by a string key is much cheaper than sorting
+        # (token, row) tuples.
+        sorted_positions = lambda tokens: sorted(xrange(len(tokens)),
+                                                 key=tokens.__getitem__)
+
+        if previous is None:
+            new_rows = xrange(len(search_tokens))
+        else:
+            new_rows = set(xrange(len(search_tokens)))
+            new_rows.difference_update(row_map)
+            new_rows = sorted(new_rows)
+        new_tokens = [token for row in new_rows for token in search_tokens[row]]
+        new_token_rows = [row for row in new_rows for token in search_tokens[row]]
+
+        if previous is None:
+            tokens, rows = new_tokens, new_token_rows
+        else:
+            # Entries of rows carried over are already sorted.  Appending
+            # the sorted entries of the new rows to them leaves two sorted
+            # runs, which the final sort merges in linear time.
+            tokens, rows = [], []
+            for token, row in itertools.izip(previous.tokens, previous.rows):
+                row = row_map[row]
+                if row is not None:
+                    tokens.append(token)
+                    rows.append(row)
+            order = sorted_positions(new_tokens)
+            tokens.extend([new_tokens[position] for position in order])
+            rows.extend([new_token_rows[position] for position in order])
+
+        order = sorted_positions(tokens)
+        self.tokens = [tokens[position] for position in order]
+        self.rows = [rows[position] for position in order]
+
+    def get_lookup_rows(self, value):
+        """
+        @type value: string
+        @param value: lower-cased fingerprint or hashed fingerprint.
+
+        @rtype: set of int
+        @return: rows having value as fingerprint or hashed fingerprint.
+        """
+
+        rows = self.lookup.get(value)
+        if rows is None:
+            return set()
+        return set(rows) if isinstance(rows, list) else set([rows])
+
+    def get_prefix_rows(self, prefix):
+        """
+        @type prefix: string
+        @param prefix: lower-cased search term.
+
+        @rtype: set of int
+        @return: rows having at least one search token starting with prefix.
+        """
+
+        # Tokens are printable ASCII, so every token starting with prefix
+        # sorts before prefix + '\xff'.
+        start = bisect.bisect_left(self.tokens, prefix)
+        end = bisect.bisect_left(self.tokens, prefix + '\xff', start)
+        return set(self.rows[start:end])
+
+    def get_search_rows(self, terms):
+        """
+        @type terms: list of string
+        @param terms: lower-cased search terms.
+
+        @rtype: set of int
+        @return: rows matching all of the search terms.
+        """
+
+        # Intersect the posting lists of the most selective terms first;
+        # longer terms are usually the most selective ones.
+        rows = None
+        for term in sorted(set(terms), key=len, reverse=True):
+            matches = self.get_prefix_rows(term)
+            rows = matches if rows is None else rows & matches
+            if not rows:
+                break
+        return rows
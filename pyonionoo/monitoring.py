@@ -0,0 +1,212 @@
+"""
+Counters, gauges and timing histograms of the server, exposed in the
+Prometheus text format by /metrics.
+
+Histograms and counters are updated on the hot path of every request, so
+updating them only takes a lock and a few additions.  Gauges are read
+from the running server when the metrics are rendered, and cost nothing
+in between.  Every metric is registered in METRICS when it is created.
+"""
+
+import bisect
+import collections
+import threading
+
+# Metrics by name, in rendering order.
+METRICS = collections.OrderedDict()
+
+# Histogram buckets, in seconds, for request stages and for refreshes.
+REQUEST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+REFRESH_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                     .replace('\n', '\\n')
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in zip(names, values))
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        """
+        @type name: string
+        @param name: metric name.
+
+        @type description: string
+        @param description: help text of the metric.
+
+        @type labels: tuple of string
+        @param labels: names of the labels of the metric; values are given
+            in the same order when the metric is updated.
+        """
+
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        METRICS[name] = self
+
+    def render(self):
+        """
+        @rtype: list of string
+        @return: lines of the metric in the Prometheus text format.
+        """
+
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for label_values, value in self.get_samples():
+            lines.append('%s%s %s' % (self.name,
+                                      _format_labels(self.labels, label_values),
+                                      _format_value(value)))
+        return lines
+
+    def get_samples(self):
+        """
+        @rtype: list of tuple
+        @return: (label values, value) of every series of the metric.
+        """
+
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        Metric.__init__(self, name, description, labels)
+        self.values = {}
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get_samples(self):
+        with self.lock:
+            return sorted(self.values.iteritems())
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, description, get_value, labels=(), kind='gauge'):
+        """
+        @type get_value: callable
+        @param get_value: function returning the current value of the
+            gauge, None if it has none, or a list of (label values, value)
+            tuples if the gauge has labels.
+
+        @type kind: string
+        @param kind: metric type; 'counter' for counters kept elsewhere.
+        """
+
+        Metric.__init__(self, name, description, labels)
+        self.get_value = get_value
+        self.kind = kind
+
+    def get_samples(self):
+        value = self.get_value()
+        if value is None:
+            return []
+        if self.labels:
+            return value
+        return [((), value)]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=REQUEST_BUCKETS):
+        """
+        @type buckets: tuple of float
+        @param buckets: upper bounds of the buckets, in increasing order.
+        """
+
+        Metric.__init__(self, name, description, labels)
+        self.buckets = buckets
+        # For every series, the number of observations in each bucket
+        # (not cumulative, the last one being +Inf) and their sum.
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = \
+                        [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            series = sorted((label_values, (list(counts), total))
+                            for label_values, (counts, total)
+                            in self.series.iteritems())
+        labels = self.labels + ('le',)
+        for label_values, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                        self.name, _format_labels(
+                                labels, label_values + (
+                                        bound if bound == '+Inf'
+                                        else repr(float(bound)),)),
+                        cumulative))
+            suffix = _format_labels(self.labels, label_values)
+            lines.append('%s_sum%s %r' % (self.name, suffix, total))
+            lines.append('%s_count%s %d' % (self.name, suffix, cumulative))
+        return lines
+
+def render():
+    """
+    @rtype: string
+    @return: all metrics in the Prometheus text format.
+    """
+
+    lines = []
+    for metric in METRICS.values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+REQUEST_STAGE_SECONDS = Histogram(
+        'pyonionoo_request_stage_seconds',
+        'Time spent in each stage of answering requests: parsing arguments '
+        '(parse), selecting routers (query), encoding the document (encode), '
+        'compressing it (compress) and writing it to the client (write).',
+        ('handler', 'stage'))
+
+REQUEST_SECONDS = Histogram(
+        'pyonionoo_request_seconds',
+        'Time from receiving requests to finishing their responses.',
+        ('handler',))
+
+REQUESTS = Counter(
+        'pyonionoo_requests_total',
+        'Requests answered, by handler and status code.',
+        ('handler', 'code'))
+
+REFRESH_SECONDS = Histogram(
+        'pyonionoo_refresh_seconds',
+        'Time spent building or mapping new snapshots.',
+        buckets=REFRESH_BUCKETS)
+
+WARM_UP_SECONDS = Histogram(
+        'pyonionoo_warm_up_seconds',
+        'Time spent rendering warm-up responses for new snapshots.',
+        buckets=REFRESH_BUCKETS)
+
+REFRESH_ROUTERS = Counter(
+        'pyonionoo_refresh_routers_total',
+        'Routers ingested by refreshes, by change to the previous snapshot.',
+        ('change',))
@@ -4,6 +4,80 @@ import datetime
 from binascii import a2b_hex
 from hashlib import sha1
 
+# Columns returned by parse_summary_columns(), i.e., the attributes of
+# Router that are read from a summary file line.
+SUMMARY_COLUMNS = ('type', 'nickname', 'fingerprint', 'hashed_fingerprint',
+                   'address', 'or_addresses', 'exit_addresses',
+                   'time_published', 'or_port', 'dir_port', 'flags', 'running',
+                   'consensus_weight', 'country_code', 'hostname',
+                   'time_lookup')
+
+def parse_summary_columns(lines):
+    """
+    Parse the lines of a summary file column-wise.  This is equivalent to
+    calling Router.parse() on every line, but does not create a Router per
+    line, and parses every distinct publication timestamp only once (most
+    routers share one of a handful of timestamps).
+
+    @type lines: iterable of string
+    @param lines: summary file lines; blank lines are skipped.
+
+    @rtype: dict of string -> list
+    @return: dictionary mapping each name in SUMMARY_COLUMNS to the list of
+        values of that attribute, one per router, in file order.
+    """
+
+    columns = dict((column, []) for column in SUMMARY_COLUMNS)
+    (types, nicknames, fingerprints, hashed_fingerprints, addresses,
+     or_addresses, exit_addresses, times_published, or_ports, dir_ports,
+     flags, running, consensus_weights, country_codes, hostnames,
+     times_lookup) = [columns[column] for column in SUMMARY_COLUMNS]
+    timestamps = {}
+
+    for line in lines:
+        values = line.split()
+        if not values:
+            continue
+        if len(values) < 13:
+            raise ValueError("Invalid router!")
+
+        types.append('r' if values[0] == 'r' else 'b')
+        nicknames.append(values[1])
+        fingerprints.append(values[2])
+        hashed_fingerprints.append(sha1(a2b_hex(values[2])).hexdigest())
+
+        address_parts = values[3].split(';')
+        addresses.append(address_parts[0])
+        or_addresses.append(address_parts[1].split(',')
+                            if len(address_parts) > 1 and address_parts[1]
+                            else None)
+        exit_addresses.append(address_parts[2].split(',')
+                              if len(address_parts) > 2 and address_parts[2]
+                              else None)
+
+        published = values[4] + ' ' + values[5]
+        timestamp = timestamps.get(published)
+        if timestamp is None:
+            try:
+                timestamp = datetime.datetime.strptime(published,
+                                                       "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                raise ValueError("Timestamp wasn't parseable: %s" % published)
+            timestamps[published] = timestamp
+        times_published.append(timestamp)
+
+        or_ports.append(int(values[6]))
+        dir_ports.append(int(values[7]))
+        router_flags = values[8].split(',')
+        flags.append(router_flags)
+        running.append('Running' in router_flags)
+        consensus_weights.append(int(values[9]))
+        country_codes.append(values[10])
+        hostnames.append(values[11] if values[11] != 'null' else None)
+        times_lookup.append(int(values[12]))
+
+    return columns
+
 class Router:
     def __init__(self):
         self.nickname = None
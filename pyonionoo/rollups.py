@@ -0,0 +1,124 @@
+"""
+Rollups of the routers of a snapshot, for the aggregates served by
+/aggregate.
+
+A rollup cell is the number of routers and the sum of their consensus
+weights for one combination of the attributes that aggregates can be
+filtered and grouped by:  running, type, country and set of flags.  Cells
+are computed once per snapshot, and there are typically a few thousand
+of them, however many routers there are; any aggregate is a sum over the
+cells that match its filters, so requests never touch router rows.
+"""
+
+import itertools
+
+from pyonionoo.encoder import encode_string
+
+# Attributes that aggregates can be grouped by.
+GROUP_BY_FIELDS = ('country', 'flag', 'type', 'running')
+
+# Values that aggregates can sum, besides counting routers.
+METRICS = ('consensus_weight',)
+
+TYPE_NAMES = {'r': 'relay', 'b': 'bridge'}
+
+def build_rollups(snapshot):
+    """
+    @type snapshot: Snapshot
+    @param snapshot: snapshot to build the rollups of.
+
+    @rtype: Rollups
+    @return: rollups of the routers of snapshot.
+    """
+
+    cells = {}
+    for running, router_type, country, flags, weight in itertools.izip(
+            snapshot.running, snapshot.type, snapshot.country_code_lower,
+            snapshot.flags.masks, snapshot.consensus_weight):
+        key = (bool(running), router_type, country, flags)
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = [0, 0]
+        cell[0] += 1
+        cell[1] += weight
+    return Rollups([key + tuple(cell) for key, cell in cells.iteritems()])
+
+class Rollups(object):
+    def __init__(self, cells):
+        """
+        @type cells: list of tuple
+        @param cells: rollup cells, as tuples of form (running, type,
+            country, flags, count, consensus_weight), where flags is a
+            bitmask of the flags in the snapshot's flags column.
+        """
+
+        self.cells = cells
+
+    def get_groups(self, flag_names, running_filter=None, type_filter=None,
+                   country_filter=None, group_by=None):
+        """
+        @type flag_names: tuple of string
+        @param flag_names: names of the flag bits, see
+            columns.FlagsColumn.
+
+        @type group_by: string
+        @param group_by: one of GROUP_BY_FIELDS, or None to aggregate all
+            matching routers into one group.
+
+        @rtype: list of tuple
+        @return: tuples of form (value, count, consensus_weight) for every
+            group, ordered by value.  Routers are counted in the group of
+            each of their flags when grouped by flag.
+        """
+
+        if country_filter:
+            country_filter = country_filter.lower()
+        groups = {}
+        for running, router_type, country, flags, count, weight in self.cells:
+            if running_filter is not None and running != running_filter or \
+                    type_filter and router_type != type_filter or \
+                    country_filter and country != country_filter:
+                continue
+            if group_by == 'flag':
+                values = [name for bit, name in enumerate(flag_names)
+                          if flags & (1 << bit)]
+            elif group_by == 'country':
+                values = [country or None]
+            elif group_by == 'type':
+                values = [TYPE_NAMES[router_type]]
+            elif group_by == 'running':
+                values = [bool(running)]
+            else:
+                values = [None]
+            for value in values:
+                group = groups.get(value)
+                if group is None:
+                    group = groups[value] = [0, 0]
+                group[0] += count
+                group[1] += weight
+        return [(value,) + tuple(groups[value]) for value in sorted(groups)]
+
+def encode_group(group_by, metric, group):
+    """
+    @type group: tuple
+    @param group: group returned by Rollups.get_groups().
+
+    @rtype: string
+    @return: JSON encoding of the aggregate of a group, with the value of
+        group_by, the count and the sum of metric, if any.
+    """
+
+    value, count, weight = group
+    parts = []
+    if group_by is not None:
+        if value is None:
+            encoded = 'null'
+        elif isinstance(value, bool):
+            encoded = 'true' if value else 'false'
+        else:
+            encoded = encode_string(value)
+        parts.append('%s: %s' % (encode_string(group_by), encoded))
+    parts.append('"count": %d' % count)
+    if metric == 'consensus_weight':
+        parts.append('"consensus_weight": %d' % weight)
+    return '{' + ', '.join(parts) + '}'
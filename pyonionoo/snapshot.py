@@ -0,0 +1,909 @@
+"""
+In-process, read-only snapshot of the routers in a summary document.
+
+A Snapshot is built once per summary refresh and is never modified
+afterwards, so it can be shared by every request thread without any
+locking.  Refreshing the data means building a new Snapshot and
+replacing the module-level reference in the database module; since
+rebinding a name is atomic, a request either sees the old snapshot or
+the new one, never a mixture of both.
+
+Router data is stored column-wise:  each attribute is a sequence with
+one entry per router, and a router is identified by its row index into
+those sequences.  Columns are stored compactly (see _compact_column()),
+and RouterRow gives attribute access to the columns of a single row for
+code that needs a router object.  Aggregates are computed from the
+rollups in Snapshot.rollups, and values describing the snapshot as a
+whole, such as publication times, from Snapshot.metadata.  The fields of the detail documents are
+kept in Snapshot.details, see details.DetailsStore, and the bandwidth
+graphs in Snapshot.bandwidth, see bandwidth.BandwidthStore.
+"""
+
+import array
+import calendar
+import copy
+import itertools
+import logging
+import os
+import random
+import time
+
+from binascii import a2b_hex
+
+from pyonionoo.bandwidth import build_bandwidth
+from pyonionoo.columns import ConvertedColumn, FlagsColumn, HexColumn
+from pyonionoo.details import build_details
+from pyonionoo.encoder import encode_summary_router
+from pyonionoo.index import BitmapIndex, SearchIndex, get_bit_string, \
+        get_set_rows
+from pyonionoo.parser import parse_summary_columns
+from pyonionoo.rollups import build_rollups
+
+# Columns kept for every router:  its summary file line and the attributes
+# parsed from that line.
+COLUMNS = ('line', 'type', 'nickname', 'fingerprint', 'hashed_fingerprint',
+           'running', 'time_published', 'or_port', 'dir_port',
+           'consensus_weight', 'country_code', 'hostname', 'time_lookup',
+           'flags', 'address', 'or_addresses', 'exit_addresses')
+
+# Columns computed from COLUMNS, see _derive_columns().
+DERIVED_COLUMNS = ('country_code_lower', 'search_tokens', 'summary_fragments')
+
+# Array type codes of the integer columns.
+ARRAY_COLUMNS = {
+    'or_port': 'H',
+    'dir_port': 'H',
+    'consensus_weight': 'l',
+    'time_lookup': 'l'
+}
+
+# String columns with few distinct values, or whose values are worth
+# sharing with the rest of the interpreter.
+INTERNED_COLUMNS = ('type', 'nickname', 'country_code', 'country_code_lower')
+
+def _compact_column(column, values):
+    """
+    @type column: string
+    @param column: name of a column in COLUMNS or DERIVED_COLUMNS.
+
+    @type values: iterable
+    @param values: values of the column.
+
+    @rtype: sequence
+    @return: values, stored in the most compact form suitable for column.
+    """
+
+    if column == 'fingerprint':
+        return HexColumn.from_values(values, 20, True)
+    if column == 'hashed_fingerprint':
+        return HexColumn.from_values(values, 20, False)
+    if column == 'flags':
+        return FlagsColumn.from_values(values)
+    if column == 'running':
+        return ConvertedColumn(array.array('B', [bool(value) for value in values]),
+                               bool)
+    if column in ARRAY_COLUMNS:
+        return array.array(ARRAY_COLUMNS[column], values)
+    if column in INTERNED_COLUMNS:
+        values = list(values)
+        if None not in values:
+            return tuple(map(intern, values))
+        return tuple(intern(value) if value is not None else None
+                     for value in values)
+    return tuple(values)
+
+# Columns that results can be ordered by.  Snapshots precompute the sort
+# order of each of them; see Snapshot.select().
+SORT_COLUMNS = ('consensus_weight', 'nickname', 'country_code_lower')
+
+# Maximum number of filter bit strings that a snapshot keeps; see
+# Snapshot.get_filter_bits().
+FILTER_BITS_ENTRIES = 64
+
+# Candidate sets smaller than this are checked against the filter bitmap
+# bit by bit, instead of through its bit string.
+FEW_CANDIDATES = 16
+
+# Request parameters that make up the shape of a query, in the order of
+# Snapshot.select() arguments.
+QUERY_PARAMETERS = ('running', 'type', 'lookup', 'country', 'search', 'order',
+                    'offset', 'limit', 'cursor')
+
+# Query plans by query shape; see get_query_plan().
+QUERY_PLANS = {}
+
+# Number of random bits at the end of a generation; see new_generation().
+GENERATION_NONCE_BITS = 10
+
+class QueryPlan(object):
+    """
+    How Snapshot.select() answers the queries of one shape, that is, the
+    queries with the same request parameters present, whatever their
+    values.  There are few shapes, and each of them is planned once.
+    """
+
+    def __init__(self, shape):
+        """
+        @type shape: tuple of string
+        @param shape: names in QUERY_PARAMETERS of the parameters present.
+        """
+
+        self.shape = shape
+        self.filters = tuple(name for name in ('running', 'type', 'country')
+                             if name in shape)
+        self.use_index = 'lookup' in shape or 'search' in shape
+        self.ordered = 'order' in shape
+
+        steps = []
+        if self.filters:
+            steps.append('intersect %s bitmaps' % '/'.join(self.filters))
+        if self.use_index:
+            steps.append('look up candidates in search index')
+            if self.filters:
+                steps.append('check candidates against filter')
+        else:
+            steps.append('scan filter')
+        if 'cursor' in shape:
+            steps.append('resume after cursor')
+        if self.ordered:
+            if self.use_index:
+                steps.append('sort candidates by rank')
+            else:
+                steps.append('walk presorted rows or sort matches by rank')
+        if 'offset' in shape:
+            steps.append('skip offset')
+        if 'limit' in shape:
+            steps.append('stop at limit')
+        self.steps = tuple(steps)
+
+    def __str__(self):
+        return ', '.join(self.steps)
+
+def get_query_plan(shape):
+    """
+    @type shape: tuple of string
+    @param shape: names in QUERY_PARAMETERS of the parameters present.
+
+    @rtype: QueryPlan
+    @return: plan for queries of that shape.  The first time a shape is
+        seen, its plan is made and logged.
+    """
+
+    plan = QUERY_PLANS.get(shape)
+    if plan is None:
+        plan = QUERY_PLANS.setdefault(shape, QueryPlan(shape))
+        logging.info("Query plan for (%s): %s" % (', '.join(shape), plan))
+    return plan
+
+def _sort_column(values):
+    """
+    @type values: sequence
+    @param values: values of a column.
+
+    @rtype: tuple
+    @return: tuple of form (order, ranks), where order is an array of the
+        rows sorted by value, ties in row order, and ranks is an array
+        giving for each row the rank of its value among the distinct
+        values of the column.
+    """
+
+    order = array.array('l', sorted(xrange(len(values)),
+                                    key=values.__getitem__))
+    ranks = array.array('l', [0]) * len(values)
+    rank, last = -1, object()
+    for row in order:
+        value = values[row]
+        if value != last:
+            rank, last = rank + 1, value
+        ranks[row] = rank
+    return order, ranks
+
+def _merge_column(column, old_values, new_values, kept):
+    """
+    @type kept: list
+    @param kept: for each row of the merged column, its row in old_values,
+        or None to take the next value of new_values.
+
+    @rtype: sequence
+    @return: merged values of column, stored like _compact_column() does.
+    """
+
+    if isinstance(new_values, (HexColumn, FlagsColumn)):
+        return type(new_values).merge(old_values, new_values, kept)
+    new_values = iter(new_values)
+    return _compact_column(column, [new_values.next() if row is None
+                                    else old_values[row] for row in kept])
+
+def _derive_columns(columns):
+    """
+    @type columns: dict of string -> sequence
+    @param columns: values of each of the attributes in COLUMNS.
+
+    @rtype: dict of string -> list
+    @return: values of each of the attributes in DERIVED_COLUMNS.
+    """
+
+    # Lower-cased tokens that the search and lookup parameters are
+    # matched against.  A search term matches a router if it is a
+    # prefix of one of its search tokens; a lookup value must be
+    # equal to one of its first two search tokens, the fingerprint and
+    # the hashed fingerprint.  See index.SearchIndex.
+    fingerprints_lower = [fingerprint.lower()
+                          for fingerprint in columns['fingerprint']]
+    hashed_fingerprints_lower = [hashed_fingerprint.lower() for hashed_fingerprint
+                                 in columns['hashed_fingerprint']]
+    return {
+        'country_code_lower': [(cc or '').lower() for cc in columns['country_code']],
+        'search_tokens': zip(fingerprints_lower, hashed_fingerprints_lower,
+                             [nickname.lower() for nickname in columns['nickname']],
+                             [address.lower() for address in columns['address']]),
+        # Encoded summary document entries.  Routers only change with a
+        # refresh, so responses are assembled by joining these fragments.
+        'summary_fragments': map(encode_summary_router, columns['nickname'],
+                                 columns['fingerprint'], columns['running'])
+    }
+
+def new_generation(previous=None):
+    """
+    @type previous: Snapshot
+    @param previous: current snapshot, or None.
+
+    @rtype: int
+    @return: generation for a new snapshot:  the current time in
+        milliseconds followed by GENERATION_NONCE_BITS random bits, but
+        greater than the generation of previous.  Generations therefore
+        keep increasing when the process is restarted, and snapshots
+        built by different processes have different generations.
+    """
+
+    generation = ((int(time.time() * 1000) << GENERATION_NONCE_BITS) |
+                  random.getrandbits(GENERATION_NONCE_BITS))
+    if previous is not None:
+        generation = max(generation, previous.generation + 1)
+    return generation
+
+def _get_files_modified(store_dir, mtimes, previous_modified):
+    """
+    @type store_dir: string
+    @param store_dir: directory of details documents or bandwidth files,
+        or None.
+
+    @type mtimes: sequence of float
+    @param mtimes: modification time of the file of every row, or -1.
+
+    @type previous_modified: int
+    @param previous_modified: value returned for the previous snapshot,
+        or None.
+
+    @rtype: int
+    @return: most recent modification time of the files or of their
+        directory, which changes when a file is added, replaced or
+        removed, and at least previous_modified; or None if there are
+        neither.
+    """
+
+    times = [mtime for mtime in mtimes if mtime != -1]
+    if store_dir:
+        try:
+            times.append(os.stat(store_dir).st_mtime)
+        except OSError:
+            pass
+    if previous_modified is not None:
+        times.append(previous_modified)
+    return int(max(times)) if times else None
+
+def build_snapshot(lines, generation, previous=None, details_dir=None,
+                   bandwidth_dir=None, summary_modified=None):
+    """
+    Build the snapshot of a summary file.
+
+    Routers are matched with those of the previous snapshot by
+    fingerprint.  Only the lines of new routers and of routers whose line
+    changed are parsed; everything else, including the encoded fragments
+    and the search index entries of unchanged routers, is carried over
+    from the previous snapshot.
+
+    @type lines: iterable of string
+    @param lines: summary file lines.
+
+    @type generation: int
+    @param generation: generation of the new snapshot, see
+        new_generation().
+
+    @type previous: Snapshot
+    @param previous: current snapshot, or None.
+
+    @type details_dir: string
+    @param details_dir: directory of the details documents, or None; see
+        details.build_details().
+
+    @type bandwidth_dir: string
+    @param bandwidth_dir: directory of the bandwidth files, or None; see
+        bandwidth.build_bandwidth().
+
+    @type summary_modified: float
+    @param summary_modified: modification time of the summary file, or
+        None; see Metadata.
+
+    @rtype: tuple
+    @return: tuple of form (snapshot, changes), where snapshot is the new
+             Snapshot, or previous itself if the summary file describes
+             exactly the same routers in the same order and no details
+             document or bandwidth file changed, and changes is a
+             dictionary with the number of 'inserted', 'updated', 'deleted'
+             and 'unchanged' routers, and of routers whose 'details' or
+             'bandwidth' changed.
+    """
+
+    # Rows of the previous snapshot, by binary fingerprint.
+    fingerprint_rows = previous.fingerprint.get_indexes() if previous else {}
+
+    def get_previous_row(fingerprint):
+        try:
+            return fingerprint_rows.get(a2b_hex(fingerprint))
+        except TypeError:
+            return None
+
+    kept, changed_lines = [], []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+        row = None
+        if previous is not None:
+            values = line.split(None, 3)
+            if len(values) > 2:
+                row = get_previous_row(values[2])
+            if row is not None and previous.line[row] != line:
+                row = None
+        kept.append(row)
+        if row is None:
+            changed_lines.append(line)
+
+    columns = parse_summary_columns(changed_lines)
+    columns['line'] = changed_lines
+
+    unchanged = len(kept) - len(changed_lines)
+    updated = 0
+    if previous is not None:
+        updated = sum(1 for fingerprint in columns['fingerprint']
+                      if get_previous_row(fingerprint) is not None)
+    changes = {
+        'inserted': len(changed_lines) - updated,
+        'updated': updated,
+        'deleted': (previous.size if previous else 0) - unchanged - updated,
+        'unchanged': unchanged
+    }
+
+    if previous is not None and not changed_lines and \
+            kept == range(previous.size):
+        snapshot = previous
+    else:
+        snapshot = Snapshot(columns, generation, previous, kept)
+
+    # Rows of the same routers in previous, whether their line changed or
+    # not.
+    changed_fingerprints = iter(columns['fingerprint'])
+    matched = [row if row is not None
+               else get_previous_row(changed_fingerprints.next())
+               for row in kept]
+
+    details, changes['details'] = build_details(snapshot, details_dir,
+                                                previous, kept)
+    bandwidth, changes['bandwidth'] = build_bandwidth(snapshot, bandwidth_dir,
+                                                      previous, matched)
+    # Modification times only move when the data they stand for changed,
+    # and never backwards.
+    modified = {}
+    if previous is not None:
+        for name in ('summary_modified', 'details_modified',
+                     'bandwidth_modified'):
+            if getattr(previous.metadata, name) is not None:
+                modified[name] = getattr(previous.metadata, name)
+    if snapshot is previous:
+        if not changes['details'] and not changes['bandwidth']:
+            return previous, changes
+        snapshot = previous.copy(generation)
+    else:
+        if summary_modified is None:
+            summary_modified = snapshot.metadata.summary_modified
+        if summary_modified is not None:
+            modified['summary_modified'] = max(
+                    int(summary_modified), modified.get('summary_modified', 0))
+    if changes['details']:
+        modified['details_modified'] = _get_files_modified(
+                details.details_dir, details.mtimes,
+                modified.get('details_modified'))
+    if changes['bandwidth']:
+        modified['bandwidth_modified'] = _get_files_modified(
+                bandwidth.bandwidth_dir, bandwidth.mtimes,
+                modified.get('bandwidth_modified'))
+    snapshot.details = details
+    snapshot.bandwidth = bandwidth
+    snapshot.metadata = snapshot.metadata.copy(generation, **modified)
+    return snapshot, changes
+
+class Metadata(object):
+    """
+    Values describing a snapshot as a whole, which every response needs
+    but none of them depends on:  they are computed once when the
+    snapshot is built, and can't be modified afterwards.
+
+    Attributes are the generation of the snapshot, the number of relays
+    and bridges, the most recent publication time of a relay and of a
+    bridge, as datetime objects or None if there are no relays or no
+    bridges, and the times at which the data of the snapshot last
+    changed, in seconds since the epoch (see get_last_modified()):
+
+      * summary_modified:  modification time of the summary file when
+        the routers last changed, or, if unknown, the most recent
+        publication time;
+      * details_modified and bandwidth_modified:  most recent
+        modification time of the details documents or bandwidth files,
+        or of their directories, when they last changed, or None if
+        there are none.
+    """
+
+    __slots__ = ('generation', 'relays', 'bridges', 'relays_published',
+                 'bridges_published', 'summary_modified', 'details_modified',
+                 'bandwidth_modified')
+
+    def __init__(self, generation, relays, bridges, relays_published,
+                 bridges_published, summary_modified=None,
+                 details_modified=None, bandwidth_modified=None):
+        if summary_modified is None:
+            timestamps = [timestamp for timestamp
+                          in (relays_published, bridges_published) if timestamp]
+            if timestamps:
+                summary_modified = calendar.timegm(
+                        max(timestamps).utctimetuple())
+        for name, value in zip(self.__slots__,
+                               (generation, relays, bridges, relays_published,
+                                bridges_published, summary_modified,
+                                details_modified, bandwidth_modified)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Metadata is immutable")
+
+    def get_last_modified(self, sources):
+        """
+        @type sources: tuple of string
+        @param sources: data that a document is computed from, among
+            'summary', 'details' and 'bandwidth'.
+
+        @rtype: int
+        @return: the most recent time at which any of that data changed,
+            in seconds since the epoch, or None if unknown.
+        """
+
+        times = [getattr(self, source + '_modified') for source in sources]
+        times = [value for value in times if value is not None]
+        return max(times) if times else None
+
+    def copy(self, generation, **modified):
+        """
+        @param modified: new values of summary_modified, details_modified
+            or bandwidth_modified, as keyword arguments.
+
+        @rtype: Metadata
+        @return: the same metadata, for a new generation.
+        """
+
+        values = dict((name, getattr(self, name)) for name in
+                      ('summary_modified', 'details_modified',
+                       'bandwidth_modified'))
+        values.update(modified)
+        return Metadata(generation, self.relays, self.bridges,
+                        self.relays_published, self.bridges_published,
+                        **values)
+
+def build_metadata(snapshot):
+    """
+    @type snapshot: Snapshot
+    @param snapshot: snapshot with its columns set.
+
+    @rtype: Metadata
+    @return: metadata of the snapshot.
+    """
+
+    counts = {'r': 0, 'b': 0}
+    published = {'r': None, 'b': None}
+    for router_type, time_published in itertools.izip(snapshot.type,
+                                                      snapshot.time_published):
+        counts[router_type] += 1
+        if published[router_type] is None or \
+                time_published > published[router_type]:
+            published[router_type] = time_published
+    return Metadata(snapshot.generation, counts['r'], counts['b'],
+                    published['r'], published['b'])
+
+class Snapshot(object):
+    def __init__(self, columns, generation, previous=None, kept=None):
+        """
+        Build a snapshot from parsed router attributes.
+
+        @type columns: dict of string -> sequence
+        @param columns: values of each of the attributes in COLUMNS, one
+            per router, in summary file order; see
+            parser.parse_summary_columns().  If previous is given, only
+            the values of the routers that are not kept from previous.
+
+        @type generation: int
+        @param generation: number identifying this snapshot; it increases
+            with every refresh, see new_generation().
+
+        @type previous: Snapshot
+        @param previous: snapshot to take unchanged routers from.
+
+        @type kept: list
+        @param kept: for each router of the new snapshot, its row in
+            previous if it is taken from there, or None if its values are
+            the next ones in columns.
+        """
+
+        self.generation = generation
+
+        columns = dict(columns)
+        columns.update(_derive_columns(columns))
+        for column in COLUMNS + DERIVED_COLUMNS:
+            values = _compact_column(column, columns[column])
+            if previous is not None:
+                values = _merge_column(column, getattr(previous, column),
+                                       values, kept)
+            setattr(self, column, values)
+        self.size = len(self.fingerprint)
+
+        row_map = None
+        if previous is not None:
+            row_map = [None] * previous.size
+            for row, previous_row in enumerate(kept):
+                if previous_row is not None:
+                    row_map[previous_row] = row
+        self.search_index = SearchIndex(
+                self.search_tokens,
+                previous.search_index if previous else None, row_map)
+
+        self.all_rows = (1 << self.size) - 1
+        self.running_index = BitmapIndex(self.running)
+        self.type_index = BitmapIndex(self.type)
+        self.country_index = BitmapIndex(self.country_code_lower)
+
+        self.sort_orders, self.sort_ranks = {}, {}
+        for column in SORT_COLUMNS:
+            self.sort_orders[column], self.sort_ranks[column] = \
+                    _sort_column(getattr(self, column))
+        self.rollups = build_rollups(self)
+        self.metadata = build_metadata(self)
+        self.filter_bits = {}
+
+    def get_filter_bitmap(self, running_filter, type_filter, country_filter):
+        """
+        @rtype: long
+        @return: bitmap of the rows matching the running, type and country
+            filters.
+        """
+
+        bitmap = self.all_rows
+        if running_filter is not None:
+            bitmap &= self.running_index.get(running_filter)
+        if type_filter:
+            bitmap &= self.type_index.get(type_filter)
+        if country_filter:
+            bitmap &= self.country_index.get(country_filter)
+        return bitmap
+
+    def get_filter_bits(self, running_filter, type_filter, country_filter):
+        """
+        @rtype: tuple
+        @return: tuple of form (bitmap, bits), where bitmap has the rows
+            matching the running, type and country filters set, and bits
+            is its bit string.  The most recently used filters are
+            remembered, so that common filters are only evaluated once per
+            snapshot.
+        """
+
+        key = (running_filter, type_filter, country_filter)
+        result = self.filter_bits.get(key)
+        if result is None:
+            bitmap = self.get_filter_bitmap(*key)
+            result = (bitmap, get_bit_string(bitmap, self.size))
+            if len(self.filter_bits) >= FILTER_BITS_ENTRIES:
+                self.filter_bits.clear()
+            self.filter_bits[key] = result
+        return result
+
+    def copy(self, generation):
+        """
+        @rtype: Snapshot
+        @return: snapshot with the same routers, as a new generation.
+        """
+
+        snapshot = copy.copy(self)
+        snapshot.generation = generation
+        snapshot.metadata = self.metadata.copy(generation)
+        snapshot.filter_bits = {}
+        return snapshot
+
+    def get_router(self, row):
+        """
+        @rtype: RouterRow
+        @return: attribute access to the router in row.
+        """
+
+        return RouterRow(self, row)
+
+    def get_cursor(self, row, order_fields):
+        """
+        @type row: int
+        @param row: last row of a page of results.
+
+        @type order_fields: tuple of (string, bool) tuples
+        @param order_fields: order of the results; see get_order_key().
+
+        @rtype: tuple
+        @return: tuple of form (generation, order_fields, fingerprint,
+            values) identifying the position after row, where values are
+            the values of row in the columns of order_fields.
+        """
+
+        return (self.generation, order_fields or (), self.fingerprint[row],
+                tuple(getattr(self, column)[row]
+                      for column, ascending in order_fields or ()))
+
+    def get_cursor_row(self, cursor):
+        """
+        @type cursor: tuple
+        @param cursor: position returned by get_cursor() for this snapshot.
+
+        @rtype: int
+        @return: row that cursor was created for, or None if no router of
+            this snapshot matches cursor.
+        """
+
+        generation, order_fields, fingerprint, values = cursor
+        for row in self.search_index.get_lookup_rows(fingerprint.lower()):
+            if self.fingerprint[row] == fingerprint and \
+                    self.get_cursor(row, order_fields) == cursor:
+                return row
+        return None
+
+    def select(self, running_filter=None, type_filter=None, lookup_filter=None,
+               country_filter=None, search_filter=None, order_fields=None,
+               offset_value=None, limit_value=None, cursor=None):
+        """
+        Get the row indexes of the routers matching the request parameters.
+        Parameters have the same meaning as those returned by
+        handlers.arguments.parse().
+
+        The lookup filter is a sequence of fingerprints or hashed
+        fingerprints, and matches the routers having any of them.
+
+        If a cursor is given, only the results after its position are
+        returned, so that paging through results costs the same for every
+        page.  The cursor must have been created by get_cursor() for this
+        snapshot, with the same order_fields.
+
+        @rtype: list of int
+        @return: matching row indexes, ordered and paginated.
+        """
+
+        # A parameter is present if it has a value; running_filter is the
+        # only one whose false value filters, e.g. an empty search does
+        # not.
+        plan = get_query_plan(tuple(
+                name for name, value in zip(QUERY_PARAMETERS, (
+                        running_filter, type_filter, lookup_filter,
+                        country_filter, search_filter, order_fields,
+                        offset_value, limit_value, cursor))
+                if value or value is False))
+
+        if search_filter:
+            search_filter = [(term[1:] if term[0] == '$' else term).lower()
+                             for term in search_filter]
+        if lookup_filter:
+            lookup_filter = set(fingerprint.lower() for fingerprint in lookup_filter)
+        if country_filter:
+            country_filter = country_filter.lower()
+
+        after_row = after_key = None
+        if cursor is not None:
+            after_row = self.get_cursor_row(cursor)
+            if after_row is None:
+                raise ValueError("Cursor does not match this snapshot")
+            if plan.ordered:
+                after_key = self.get_order_key(order_fields)(after_row)
+
+        offset_value = offset_value or 0
+        count = offset_value + limit_value if limit_value else None
+
+        if plan.use_index:
+            # The search index yields a usually small set of candidate
+            # rows, which only need to be checked against the filters.
+            candidates = None
+            if lookup_filter:
+                candidates = set()
+                for fingerprint in lookup_filter:
+                    candidates.update(self.search_index.get_lookup_rows(fingerprint))
+            if search_filter:
+                matches = self.search_index.get_search_rows(search_filter)
+                candidates = matches if candidates is None else candidates & matches
+            if not plan.filters:
+                rows = sorted(candidates)
+            elif len(candidates) < FEW_CANDIDATES:
+                # Testing a few bits is cheaper than making a bit string.
+                cached = self.filter_bits.get(
+                        (running_filter, type_filter, country_filter))
+                bitmap = cached[0] if cached else self.get_filter_bitmap(
+                        running_filter, type_filter, country_filter)
+                rows = sorted(row for row in candidates if (bitmap >> row) & 1)
+            else:
+                bits = self.get_filter_bits(running_filter, type_filter,
+                                            country_filter)[1]
+                rows = sorted(row for row in candidates if bits[row] == '1')
+            if after_row is not None and not plan.ordered:
+                rows = [row for row in rows if row > after_row]
+        else:
+            bits = self.get_filter_bits(running_filter, type_filter,
+                                        country_filter)[1]
+            start_row = after_row + 1 if after_row is not None else 0
+            if not plan.ordered:
+                return get_set_rows(bits, offset_value, limit_value,
+                                    start_row)
+            if count is not None and \
+                    count * self.size < bits.count('1') ** 2:
+                # Walking the presorted rows until count of them match is
+                # expected to visit count * size / matches rows; that is
+                # cheaper than sorting all matches.
+                return self.get_ordered_rows(bits, order_fields, count,
+                                             after_row)[offset_value:]
+            rows = get_set_rows(bits)
+
+        if plan.ordered:
+            key = self.get_order_key(order_fields)
+            if after_key is not None:
+                rows = [row for row in rows if key(row) > after_key]
+            rows.sort(key=key)
+        return rows[offset_value:count]
+
+    def get_order_key(self, order_fields):
+        """
+        @type order_fields: tuple of (string, bool) tuples
+        @param order_fields: columns to order by and whether in ascending
+            order, as returned by handlers.arguments.parse().
+
+        @rtype: callable
+        @return: sort key function for rows.  Ties are ordered by row,
+            in the direction of the first column, which is the order in
+            which get_ordered_rows() visits them.
+        """
+
+        size = self.size
+        keys = [(self.sort_ranks[column], 1 if ascending else -1)
+                for column, ascending in order_fields]
+        if len(keys) == 1:
+            ranks, sign = keys[0]
+            return lambda row: sign * (ranks[row] * size + row)
+        sign = keys[0][1]
+        return lambda row: tuple([key_sign * ranks[row]
+                                  for ranks, key_sign in keys] + [sign * row])
+
+    def get_ordered_rows(self, bits, order_fields, count, after_row=None):
+        """
+        Get the first rows set in a bit string, ordered, by walking the
+        presorted rows of the first column to order by.
+
+        @type bits: string
+        @param bits: bit string of the matching rows; see
+            index.get_bit_string().
+
+        @type order_fields: tuple of (string, bool) tuples
+        @param order_fields: see get_order_key().
+
+        @type count: int
+        @param count: number of rows to return.
+
+        @type after_row: int
+        @param after_row: if given, only rows after this one are returned;
+            the walk starts at its position in the presorted rows.
+
+        @rtype: list of int
+        @return: the first count matching rows.
+        """
+
+        column, ascending = order_fields[0]
+        order, ranks = self.sort_orders[column], self.sort_ranks[column]
+        size = self.size
+        single = len(order_fields) == 1
+
+        # Presorted positions are ordered by ranks[row] * size + row; find
+        # where to start with a binary search on that.
+        start, end = 0, size
+        if after_row is not None:
+            if single:
+                position = ranks[after_row] * size + after_row
+                bound = position + 1 if ascending else position
+            else:
+                bound = (ranks[after_row] + (0 if ascending else 1)) * size
+            low, high = 0, size
+            while low < high:
+                middle = (low + high) // 2
+                if ranks[order[middle]] * size + order[middle] < bound:
+                    low = middle + 1
+                else:
+                    high = middle
+            if ascending:
+                start = low
+            else:
+                end = low
+        if ascending:
+            positions = xrange(start, end)
+        else:
+            positions = xrange(end - 1, start - 1, -1)
+
+        rows = []
+        if single:
+            for position in positions:
+                row = order[position]
+                if bits[row] == '1':
+                    rows.append(row)
+                    if len(rows) == count:
+                        break
+            return rows
+
+        # Rows with the same value in the first column are ordered by the
+        # other columns, so the walk can only stop between such groups.
+        key = self.get_order_key(order_fields)
+        after_key = key(after_row) if after_row is not None else None
+        group, group_rank = [], None
+        for position in positions:
+            row = order[position]
+            if bits[row] != '1':
+                continue
+            if after_key is not None and key(row) <= after_key:
+                continue
+            if ranks[row] != group_rank:
+                rows.extend(sorted(group, key=key))
+                group, group_rank = [], ranks[row]
+                if len(rows) >= count:
+                    break
+            group.append(row)
+        rows.extend(sorted(group, key=key))
+        return rows[:count]
+
+    def get_rows(self, rows, fields):
+        """
+        Get the values of the given fields for the given rows.
+
+        @type rows: list of int
+        @param rows: row indexes, as returned by select().
+
+        @type fields: tuple of string
+        @param fields: names of the columns to return.
+
+        @rtype: list of tuple
+        @return: one tuple of values per row, in the order of fields.
+        """
+
+        columns = [getattr(self, field) for field in fields]
+        return [tuple(column[row] for column in columns) for row in rows]
+
+class RouterRow(object):
+    """
+    View of a single router of a snapshot.  Attributes are read from the
+    snapshot columns when they are accessed, so creating a RouterRow only
+    allocates two references.
+    """
+
+    __slots__ = ('snapshot', 'row')
+
+    def __init__(self, snapshot, row):
+        self.snapshot = snapshot
+        self.row = row
+
+    def __getattr__(self, name):
+        try:
+            column = getattr(self.snapshot, name)
+        except AttributeError:
+            raise AttributeError(name)
+        return column[self.row]
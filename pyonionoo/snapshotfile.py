@@ -0,0 +1,392 @@
+"""
+Share a snapshot between processes through a memory-mapped file.
+
+When several server processes run on the same host, a single loader
+process builds snapshots from the summary file and publishes each of them
+with write_snapshot(); worker processes map the published file with
+MappedSnapshot and serve requests straight from the mapping.  All workers
+share the same physical pages, so memory use and refresh work do not grow
+with the number of processes.
+
+A snapshot file consists of:
+
+  * the magic string MAGIC;
+  * the length of the header, as a 4-byte unsigned integer;
+  * the header, a JSON object with the generation and size of the
+    snapshot, its metadata, its rollup cells and the position of every section of the
+    file;
+  * the sections:  columns, bitmaps, search index, sort orders, detail
+    fields and bandwidth graphs.
+
+Columns of strings are stored as string tables (see
+columns.StringColumn), fingerprints as their binary values, and flags as
+bitmasks with the flag names in the header.  Integers, booleans and
+timestamps are stored as arrays of native integers, so a snapshot file
+must be read on the host that wrote it.  Bitmaps are stored as
+hexadecimal strings.
+
+Publication is atomic:  the file is written under a temporary name and
+then renamed over the previous one.  Workers keep using the mapping of
+the previous file, which stays valid after the rename, until they have
+mapped the new one.
+"""
+
+import array
+import bisect
+import calendar
+import datetime
+import json
+import mmap
+import os
+import struct
+
+from pyonionoo.bandwidth import GRAPH_NAMES, HISTORIES, BandwidthStore
+from pyonionoo.columns import ArrayColumn, ConvertedColumn, FlagsColumn, \
+        HexColumn, StringColumn
+from pyonionoo.details import DetailsStore
+from pyonionoo.index import BitmapIndex, SearchIndex
+from pyonionoo.rollups import Rollups
+from pyonionoo.snapshot import Metadata, Snapshot
+
+MAGIC = 'PYONSNP2'
+
+# Array type code for integer columns.
+INT_TYPECODE = 'l'
+
+# How each column is stored; see write_snapshot().
+COLUMN_KINDS = {
+    'type': 'string',
+    'nickname': 'string',
+    'fingerprint': 'hex',
+    'hashed_fingerprint': 'hex',
+    'running': 'bool',
+    'time_published': 'time',
+    'or_port': 'int',
+    'dir_port': 'int',
+    'consensus_weight': 'int',
+    'country_code': 'string',
+    'country_code_lower': 'string',
+    'hostname': 'string',
+    'time_lookup': 'int',
+    'flags': 'flags',
+    'address': 'string',
+    'or_addresses': 'list',
+    'exit_addresses': 'list',
+    'summary_fragments': 'string'
+}
+
+# Bitmap indexes stored in the file.
+BITMAP_INDEXES = ('running_index', 'type_index', 'country_index')
+
+def _split_list(value):
+    return value.split(',') if value is not None else None
+
+def _encode_column(kind, values):
+    if kind == 'string':
+        return StringColumn.encode(values)
+    if kind == 'hex':
+        return values.get_buffer()
+    if kind == 'flags':
+        return values.masks.tostring()
+    if kind == 'list':
+        return StringColumn.encode(None if value is None else ','.join(value)
+                                   for value in values)
+    if kind == 'bool':
+        return array.array('B', [bool(value) for value in values]).tostring()
+    if kind == 'time':
+        return array.array(INT_TYPECODE, [calendar.timegm(value.utctimetuple())
+                                          for value in values]).tostring()
+    return array.array(INT_TYPECODE, values).tostring()
+
+def _encode_metadata(metadata):
+    timestamp = lambda value: (calendar.timegm(value.utctimetuple())
+                               if value is not None else None)
+    return {'relays': metadata.relays,
+            'bridges': metadata.bridges,
+            'relays_published': timestamp(metadata.relays_published),
+            'bridges_published': timestamp(metadata.bridges_published),
+            'summary_modified': metadata.summary_modified,
+            'details_modified': metadata.details_modified,
+            'bandwidth_modified': metadata.bandwidth_modified}
+
+def _decode_metadata(generation, values):
+    timestamp = lambda value: (datetime.datetime.utcfromtimestamp(value)
+                               if value is not None else None)
+    return Metadata(generation, values['relays'], values['bridges'],
+                    timestamp(values['relays_published']),
+                    timestamp(values['bridges_published']),
+                    values['summary_modified'], values['details_modified'],
+                    values['bandwidth_modified'])
+
+def write_snapshot(snapshot, path):
+    """
+    Publish a snapshot as a snapshot file, replacing the previous one
+    atomically.
+
+    @type snapshot: Snapshot
+    @param snapshot: snapshot to publish.
+
+    @type path: string
+    @param path: path of the snapshot file.
+    """
+
+    sections = []
+    header = {
+        'generation': snapshot.generation,
+        'size': snapshot.size,
+        'itemsize': array.array(INT_TYPECODE).itemsize,
+        'columns': {},
+        'flag_names': snapshot.flags.names,
+        'hex_upper': dict((column, getattr(snapshot, column).upper)
+                          for column, kind in COLUMN_KINDS.iteritems()
+                          if kind == 'hex'),
+        'bitmaps': {},
+        'search_index': {},
+        'sort_columns': {},
+        'details': {},
+        'bandwidth': {},
+        'rollups': snapshot.rollups.cells,
+        'metadata': _encode_metadata(snapshot.metadata)
+    }
+
+    def add_section(data):
+        sections.append(data)
+        return len(sections) - 1
+
+    for column, kind in COLUMN_KINDS.iteritems():
+        header['columns'][column] = add_section(
+                _encode_column(kind, getattr(snapshot, column)))
+
+    for name in BITMAP_INDEXES:
+        bitmaps = getattr(snapshot, name).bitmaps
+        header['bitmaps'][name] = [(value, add_section('%x' % bitmap))
+                                   for value, bitmap in bitmaps.iteritems()]
+
+    search_index = snapshot.search_index
+    lookup_keys, lookup_rows = [], []
+    for key, rows in sorted(search_index.lookup.iteritems()):
+        for row in (rows if isinstance(rows, list) else [rows]):
+            lookup_keys.append(key)
+            lookup_rows.append(row)
+    header['search_index'] = {
+        'count': len(search_index.tokens),
+        'tokens': add_section(StringColumn.encode(search_index.tokens)),
+        'rows': add_section(array.array(INT_TYPECODE,
+                                        search_index.rows).tostring()),
+        'lookup_count': len(lookup_keys),
+        'lookup_keys': add_section(StringColumn.encode(lookup_keys)),
+        'lookup_rows': add_section(array.array(INT_TYPECODE,
+                                               lookup_rows).tostring())
+    }
+
+    for column, order in snapshot.sort_orders.iteritems():
+        header['sort_columns'][column] = (
+                add_section(array.array(INT_TYPECODE, order).tostring()),
+                add_section(array.array(INT_TYPECODE,
+                                        snapshot.sort_ranks[column]).tostring()))
+
+    details = snapshot.details
+    header['details'] = {
+        'dir': details.details_dir,
+        'records': add_section(StringColumn.encode(details.records)),
+        'large_records': add_section(StringColumn.encode(details.large_records)),
+        'mtimes': add_section(array.array('d', details.mtimes).tostring())
+    }
+
+    bandwidth = snapshot.bandwidth
+    header['bandwidth'] = {
+        'dir': bandwidth.bandwidth_dir,
+        'slot_count': len(bandwidth.ends),
+        'slots': add_section(array.array('i', bandwidth.slots).tostring()),
+        'mtimes': add_section(array.array('d', bandwidth.mtimes).tostring()),
+        'ends': add_section(array.array('d', bandwidth.ends).tostring()),
+        'graphs': dict((name, (add_section(bandwidth.get_buffer(name)),
+                               add_section(array.array(
+                                       'd', bandwidth.graphs[name][2]).tostring())))
+                       for name in GRAPH_NAMES)
+    }
+
+    # Sections are referred to by index above; turn them into offsets
+    # relative to the end of the header.
+    positions, position = [], 0
+    for data in sections:
+        positions.append(position)
+        position += len(data)
+    header['sections'] = positions
+
+    encoded_header = json.dumps(header)
+    temporary_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('!I', len(encoded_header)))
+        f.write(encoded_header)
+        for data in sections:
+            f.write(data)
+    os.rename(temporary_path, path)
+
+def _get_identity(stat):
+    return (stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size)
+
+def get_file_identity(path):
+    """
+    @rtype: tuple
+    @return: identity of the snapshot file at path; it changes every time
+        a snapshot is published to path.  Compare it with the
+        file_identity of a MappedSnapshot.
+    """
+
+    return _get_identity(os.stat(path))
+
+def _read_header(prefix, f):
+    if prefix[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a snapshot file")
+    (length,) = struct.unpack('!I', prefix[len(MAGIC):len(MAGIC) + 4])
+    return json.loads(f.read(length)), len(MAGIC) + 4 + length
+
+class MappedBitmapIndex(BitmapIndex):
+    """
+    Bitmap index whose bitmaps are decoded from the snapshot file the
+    first time they are used.
+    """
+
+    def __init__(self, mapping, sections):
+        self.mapping = mapping
+        self.sections = dict((value, section) for value, section in sections)
+        self.bitmaps = {}
+
+    def get(self, value):
+        bitmap = self.bitmaps.get(value)
+        if bitmap is None:
+            section = self.sections.get(value)
+            if section is None:
+                return 0
+            offset, length = section
+            bitmap = long(self.mapping[offset:offset + length], 16)
+            self.bitmaps[value] = bitmap
+        return bitmap
+
+class MappedSearchIndex(SearchIndex):
+    """
+    Search index whose sorted tokens are read from the snapshot file.
+    Lookups use a binary search over sorted keys instead of a dict.
+    """
+
+    def __init__(self, tokens, rows, lookup_keys, lookup_rows):
+        self.tokens = tokens
+        self.rows = rows
+        self.lookup_keys = lookup_keys
+        self.lookup_rows = lookup_rows
+
+    def get_lookup_rows(self, value):
+        start = bisect.bisect_left(self.lookup_keys, value)
+        end = bisect.bisect_right(self.lookup_keys, value, start)
+        return set(self.lookup_rows[start:end])
+
+class MappedSnapshot(Snapshot):
+    """
+    Snapshot served from a snapshot file written by write_snapshot().
+    Its file_identity is that of the file it was mapped from, see
+    get_file_identity().
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header, header_end = _read_header(f.read(len(MAGIC) + 4), f)
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.file_identity = _get_identity(os.fstat(f.fileno()))
+
+        if header['itemsize'] != array.array(INT_TYPECODE).itemsize:
+            raise ValueError("Snapshot file written on another platform")
+
+        self.generation = header['generation']
+        self.size = header['size']
+        sections = header['sections']
+        offset = lambda section: header_end + sections[section]
+        end = lambda section: (header_end + sections[section + 1]
+                               if section + 1 < len(sections)
+                               else len(self.mapping))
+
+        for column, kind in COLUMN_KINDS.iteritems():
+            position = offset(header['columns'][column])
+            if kind in ('string', 'list'):
+                values = StringColumn(self.mapping, position, self.size)
+                if kind == 'list':
+                    values = ConvertedColumn(values, _split_list)
+            elif kind == 'hex':
+                values = HexColumn(self.mapping, position, self.size, 20,
+                                   header['hex_upper'][column])
+            elif kind == 'flags':
+                values = FlagsColumn(
+                        ArrayColumn(self.mapping, position, self.size, 'L'),
+                        tuple(str(name) for name in header['flag_names']))
+            elif kind == 'bool':
+                values = ConvertedColumn(
+                        ArrayColumn(self.mapping, position, self.size, 'B'),
+                        bool)
+            elif kind == 'time':
+                values = ConvertedColumn(
+                        ArrayColumn(self.mapping, position, self.size,
+                                    INT_TYPECODE),
+                        datetime.datetime.utcfromtimestamp)
+            else:
+                values = ArrayColumn(self.mapping, position, self.size,
+                                     INT_TYPECODE)
+            setattr(self, column, values)
+
+        for name in BITMAP_INDEXES:
+            setattr(self, name, MappedBitmapIndex(
+                    self.mapping,
+                    [(value, (offset(section), end(section) - offset(section)))
+                     for value, section in header['bitmaps'][name]]))
+        self.all_rows = (1 << self.size) - 1
+        self.filter_bits = {}
+
+        self.sort_orders, self.sort_ranks = {}, {}
+        for column, (order, ranks) in header['sort_columns'].iteritems():
+            column = str(column)
+            self.sort_orders[column] = ArrayColumn(
+                    self.mapping, offset(order), self.size, INT_TYPECODE)
+            self.sort_ranks[column] = ArrayColumn(
+                    self.mapping, offset(ranks), self.size, INT_TYPECODE)
+
+        details = header['details']
+        self.details = DetailsStore(
+                details['dir'],
+                StringColumn(self.mapping, offset(details['records']), self.size),
+                StringColumn(self.mapping, offset(details['large_records']),
+                             self.size),
+                ArrayColumn(self.mapping, offset(details['mtimes']), self.size,
+                            'd'))
+
+        bandwidth = header['bandwidth']
+        slot_count = bandwidth['slot_count']
+        self.bandwidth = BandwidthStore(
+                bandwidth['dir'],
+                ArrayColumn(self.mapping, offset(bandwidth['slots']), self.size,
+                            'i'),
+                ArrayColumn(self.mapping, offset(bandwidth['mtimes']), self.size,
+                            'd'),
+                ArrayColumn(self.mapping, offset(bandwidth['ends']), slot_count,
+                            'd'),
+                dict((str(name), (self.mapping, offset(values),
+                                  ArrayColumn(self.mapping, offset(factors),
+                                              slot_count * len(HISTORIES), 'd')))
+                     for name, (values, factors)
+                     in bandwidth['graphs'].iteritems()))
+
+        self.rollups = Rollups([
+                (running, str(router_type), str(country), flags, count, weight)
+                for running, router_type, country, flags, count, weight
+                in header['rollups']])
+        self.metadata = _decode_metadata(self.generation, header['metadata'])
+
+        search_index = header['search_index']
+        self.search_index = MappedSearchIndex(
+                StringColumn(self.mapping, offset(search_index['tokens']),
+                             search_index['count']),
+                ArrayColumn(self.mapping, offset(search_index['rows']),
+                            search_index['count'], INT_TYPECODE),
+                StringColumn(self.mapping, offset(search_index['lookup_keys']),
+                             search_index['lookup_count']),
+                ArrayColumn(self.mapping, offset(search_index['lookup_rows']),
+                            search_index['lookup_count'], INT_TYPECODE))
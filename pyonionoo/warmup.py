@@ -0,0 +1,108 @@
+"""
+Render popular documents for a new snapshot before it is served.
+
+Right after a refresh, the first requests for common documents would all
+find an empty response cache at the same moment.  Instead, the queries
+configured in the [warmup] section are answered against every new
+snapshot while the previous one is still served, compressed with every
+enabled content encoding, and staged in the response cache (see
+cache.ResponseCache.put_staged()), so that they are cached as soon as the
+new snapshot is.
+"""
+
+import logging
+import time
+import urlparse
+
+import cyclone.web
+
+from pyonionoo import compression, monitoring
+from pyonionoo.handlers import arguments
+
+class WarmUp(object):
+    def __init__(self, cache, routes, queries, encodings, max_size):
+        """
+        @type cache: ResponseCache
+        @param cache: response cache to stage rendered documents in.
+
+        @type routes: dict of string -> class
+        @param routes: handler class of each path; see
+            handlers.base.BaseHandler.allowed_arguments.
+
+        @type queries: list of string
+        @param queries: paths with query strings of the documents to
+            render, e.g. '/summary?running=true'.
+
+        @type encodings: list of string
+        @param encodings: content encodings to compress documents with.
+
+        @type max_size: int
+        @param max_size: maximum size of a cached document.
+        """
+
+        self.cache = cache
+        self.encodings = encodings
+        self.max_size = max_size
+        self.queries = []
+        for query in queries:
+            path, _, query_string = query.partition('?')
+            handler_class = routes.get(path)
+            if not getattr(handler_class, 'allowed_arguments', None):
+                raise ValueError("Invalid warm-up query: %s" % query)
+            try:
+                parsed_arguments = arguments.parse(
+                        urlparse.parse_qs(query_string, keep_blank_values=True),
+                        handler_class.allowed_arguments)
+            except cyclone.web.HTTPError, e:
+                raise ValueError("Invalid warm-up query %s: %s" %
+                                 (query, e.log_message))
+            if parsed_arguments.get('cursor') is not None:
+                raise ValueError("Warm-up queries can't have a cursor: %s" %
+                                 query)
+            cache_key = (path, arguments.normalize(parsed_arguments))
+            self.queries.append((query, handler_class, parsed_arguments,
+                                 cache_key))
+
+    def __call__(self, snapshot):
+        """
+        Render the documents of all queries for snapshot, and stage them
+        in the response cache.  Called in the refresh thread, before
+        snapshot is served; queries that fail are logged and skipped.
+
+        @type snapshot: Snapshot
+        @param snapshot: the new snapshot.
+        """
+
+        if not self.queries or not self.cache.max_entries:
+            return
+        start = time.time()
+        entries = []
+        for query, handler_class, parsed_arguments, cache_key in self.queries:
+            try:
+                document = ''.join(handler_class.get_document(parsed_arguments,
+                                                              snapshot))
+            except Exception, e:
+                logging.warning("Could not render warm-up query %s: %s" %
+                                (query, e))
+                continue
+            if len(document) > self.max_size:
+                logging.warning("Warm-up query %s is too large to be cached" %
+                                query)
+                continue
+
+            entries.append((cache_key, document))
+            if len(document) >= compression.MIN_SIZE:
+                for encoding in self.encodings:
+                    entries.append((cache_key + (encoding,),
+                                    compression.compress(
+                                            document, encoding,
+                                            compression.LEVELS[encoding][1])))
+
+        # Queries are configured most important first; staged entries are
+        # most recently used last.
+        entries.reverse()
+        self.cache.put_staged(snapshot.generation, entries)
+        elapsed = time.time() - start
+        monitoring.WARM_UP_SECONDS.observe(elapsed)
+        logging.info("Rendered %d warm-up responses in %.3f s" %
+                     (len(entries), elapsed))
@@ -0,0 +1,150 @@
+"""
+Schedule snapshot refreshes when the summary file changes.
+
+Everything here runs in the reactor thread; only the refresh itself runs
+in the reactor's thread pool.  Changes are detected with inotify where it
+is available, and by polling the modification time of the file otherwise.
+"""
+
+import logging
+import os
+
+from twisted.internet import reactor, task, threads
+from twisted.python import filepath
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+# Number of seconds without any further change to the summary file after
+# which it is considered completely written.
+DEBOUNCE_DELAY = 0.5
+
+# Interval (in seconds) at which the modification time of the summary file
+# is checked when inotify is not available.
+POLL_INTERVAL = 60
+
+class SummaryWatcher(object):
+    def __init__(self, summary_file, refresh, debounce_delay=DEBOUNCE_DELAY,
+                 poll_interval=POLL_INTERVAL):
+        """
+        @type summary_file: string
+        @param summary_file: full path to the summary file.
+
+        @type refresh: callable
+        @param refresh: function called in a pool thread with summary_file
+            as argument to refresh the snapshot; e.g.,
+            database.update_databases.
+        """
+
+        self.summary_file = summary_file
+        self.refresh = refresh
+        self.debounce_delay = debounce_delay
+        self.poll_interval = poll_interval
+
+        self.notifier = None
+        self.poller = None
+        self.last_mtime = None
+
+        # Pending debounce timer, refresh in progress, and whether another
+        # refresh is needed once the current one has finished.
+        self.delayed_call = None
+        self.in_flight = None
+        self.dirty = False
+
+    def start(self):
+        if inotify is not None:
+            try:
+                self.notifier = inotify.INotify()
+                self.notifier.startReading()
+                # Watch the directory rather than the file, so that the
+                # summary file can be replaced by renaming a new one over it.
+                self.notifier.watch(
+                    filepath.FilePath(os.path.dirname(self.summary_file)),
+                    mask=(inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE |
+                          inotify.IN_MOVED_TO | inotify.IN_CREATE),
+                    callbacks=[self._notified])
+                logging.info("Watching %s with inotify" % self.summary_file)
+                return
+            except Exception, e:
+                logging.info("inotify unavailable (%s)" % e)
+                self.notifier = None
+
+        self.last_mtime = self._get_mtime()
+        self.poller = task.LoopingCall(self._poll)
+        self.poller.start(self.poll_interval, now=False)
+        logging.info("Polling %s every %d s" % (self.summary_file,
+                                                 self.poll_interval))
+
+    def stop(self):
+        """
+        Stop watching the summary file and cancel any scheduled refresh.
+        A refresh that is already running in a pool thread completes, but
+        does not trigger further refreshes.
+        """
+
+        if self.notifier is not None:
+            # On reactor shutdown, the reactor removes the notifier from
+            # its readers and closes it itself; closing it here as well
+            # would close its file descriptor twice.
+            if self.notifier.connected and \
+                    self.notifier in reactor.getReaders():
+                self.notifier.loseConnection()
+            self.notifier = None
+        if self.poller is not None and self.poller.running:
+            self.poller.stop()
+        self.poller = None
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+        self.dirty = False
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.summary_file).st_mtime
+        except OSError:
+            return None
+
+    def _notified(self, ignored, path, mask):
+        if path.path == self.summary_file:
+            self.schedule()
+
+    def _poll(self):
+        mtime = self._get_mtime()
+        if mtime != self.last_mtime:
+            self.last_mtime = mtime
+            self.schedule()
+
+    def schedule(self):
+        """
+        Refresh once the summary file has not changed for debounce_delay
+        seconds, so that partially written files are not read.
+        """
+
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.reset(self.debounce_delay)
+        else:
+            self.delayed_call = reactor.callLater(self.debounce_delay,
+                                                  self._start_refresh)
+
+    def _start_refresh(self):
+        self.delayed_call = None
+        if self.in_flight is not None:
+            # At most one refresh at a time; run another one afterwards.
+            self.dirty = True
+            return
+
+        self.in_flight = threads.deferToThread(self.refresh, self.summary_file)
+        self.in_flight.addErrback(self._refresh_failed)
+        self.in_flight.addBoth(self._refresh_done)
+
+    def _refresh_failed(self, failure):
+        logging.error("Refreshing from %s failed: %s" %
+                      (self.summary_file, failure.getErrorMessage()))
+
+    def _refresh_done(self, ignored):
+        self.in_flight = None
+        if self.dirty:
+            self.dirty = False
+            self._start_refresh()
@@ -15,19 +15,32 @@
 # under the License.
 
 import logging
+import os
+import time
 
 import cyclone.locale
 import cyclone.web
 import handlers.summary as summary
 import handlers.detail as detail
+import handlers.bandwidth as bandwidth
+import handlers.aggregate as aggregate
+import handlers.monitoring as monitoring_handlers
 
-from pyonionoo import config, database
+from twisted.internet import reactor
+
+from pyonionoo import compression, config, database, monitoring
+from pyonionoo.cache import ResponseCache
+from pyonionoo.warmup import WarmUp
+from pyonionoo.watcher import SummaryWatcher
 
 class Application(cyclone.web.Application):
     def __init__(self, config_file):
         handlers = [
             (r"/summary",              summary.SummaryHandler),
-            (r"/detail",               detail.DetailHandler)
+            (r"/detail",               detail.DetailHandler),
+            (r"/bandwidth",            bandwidth.BandwidthHandler),
+            (r"/aggregate",            aggregate.AggregateHandler),
+            (r"/metrics",              monitoring_handlers.MetricsHandler)
         ]
 
         logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
@@ -36,12 +49,120 @@ class Application(cyclone.web.Application):
         if not settings['metrics_out']:
             raise ValueError
 
-        database.bootstrap_database(settings['metrics_out'], settings['summary_file'])
+        self.response_cache = ResponseCache(settings['cache_entries'])
+        settings['compression_encodings'] = self.get_encodings(
+                settings['compression_encodings'])
+        # Set up the warm-up before the first snapshot is loaded, so that
+        # it is warmed up too.
+        database.WARM_UP = WarmUp(self.response_cache, dict(handlers),
+                                  settings['warmup_queries'],
+                                  settings['compression_encodings'],
+                                  settings['cache_entry_size'])
+
+        if settings['snapshot_mode'] == 'worker':
+            # Workers never read the summary file; they follow the
+            # snapshot file published by the loader instead.  If the
+            # loader has not published it yet, the watcher loads it once
+            # it appears.
+            try:
+                database.load_snapshot(settings['snapshot_file'])
+            except (IOError, ValueError), e:
+                logging.error("Could not load snapshot file %s (%s); waiting "
+                              "for the loader to publish it" %
+                              (settings['snapshot_file'], e))
+            self.watcher = SummaryWatcher(settings['snapshot_file'],
+                                          database.load_snapshot)
+        else:
+            snapshot_file = None
+            if settings['snapshot_mode'] == 'loader':
+                snapshot_file = settings['snapshot_file']
+            database.bootstrap_database(settings['metrics_out'],
+                                        settings['summary_file'], snapshot_file,
+                                        settings['details_dir'],
+                                        settings['bandwidth_dir'])
+            self.watcher = SummaryWatcher(
+                    os.path.join(settings['metrics_out'], settings['summary_file']),
+                    database.update_databases)
+
+        reactor.suggestThreadPoolSize(settings['thread_pool_size'])
+        self.register_gauges()
         
         cyclone.web.Application.__init__(self, handlers, **settings)
 
+    def get_encodings(self, encodings):
+        """
+        @type encodings: list of string
+        @param encodings: configured content encodings.
+
+        @rtype: list of string
+        @return: the configured encodings that are available.
+        """
+        available = []
+        for encoding in encodings:
+            if encoding not in compression.ENCODINGS:
+                raise ValueError("Invalid content encoding: %s" % encoding)
+            if compression.is_available(encoding):
+                available.append(encoding)
+            else:
+                logging.warning("Content encoding %s is not available" %
+                                encoding)
+        return available
+
+    def register_gauges(self):
+        """
+        Register the gauges of /metrics that are read from the snapshot,
+        the response cache and the thread pool.
+        """
+        cache = self.response_cache
+
+        def get_snapshot_value(get_value):
+            snapshot = database.SNAPSHOT
+            return get_value(snapshot) if snapshot is not None else None
+
+        def get_hit_ratio():
+            lookups = cache.hits + cache.misses
+            return float(cache.hits) / lookups if lookups else None
+
+        monitoring.Gauge('pyonionoo_snapshot_generation',
+                         'Generation of the snapshot being served.',
+                         lambda: get_snapshot_value(
+                                 lambda snapshot: snapshot.generation))
+        monitoring.Gauge('pyonionoo_snapshot_routers',
+                         'Routers in the snapshot being served.',
+                         lambda: get_snapshot_value(
+                                 lambda snapshot: snapshot.size))
+        monitoring.Gauge('pyonionoo_snapshot_age_seconds',
+                         'Time since the snapshot being served was published.',
+                         lambda: time.time() - database.SNAPSHOT_TIME
+                                 if database.SNAPSHOT_TIME else None)
+        monitoring.Gauge('pyonionoo_response_cache_hits_total',
+                         'Responses found in the response cache.',
+                         lambda: cache.hits, kind='counter')
+        monitoring.Gauge('pyonionoo_response_cache_misses_total',
+                         'Responses not found in the response cache.',
+                         lambda: cache.misses, kind='counter')
+        monitoring.Gauge('pyonionoo_response_cache_hit_ratio',
+                         'Fraction of response cache lookups that were hits.',
+                         get_hit_ratio)
+        monitoring.Gauge('pyonionoo_response_cache_entries',
+                         'Responses in the response cache.',
+                         lambda: len(cache.entries))
+        monitoring.Gauge('pyonionoo_thread_pool_queue_depth',
+                         'Calls waiting for a thread of the thread pool.',
+                         lambda: reactor.getThreadPool().q.qsize())
+        monitoring.Gauge('pyonionoo_thread_pool_busy_threads',
+                         'Threads of the thread pool running a call.',
+                         lambda: len(reactor.getThreadPool().working))
+        monitoring.Gauge('pyonionoo_thread_pool_max_threads',
+                         'Maximum number of threads of the thread pool.',
+                         lambda: reactor.getThreadPool().max)
+
+    def startFactory(self):
+        cyclone.web.Application.startFactory(self)
+        self.watcher.start()
+
     def stopFactory(self):
         print 'stopFactory'
-        database.cancel_freshen()
+        self.watcher.stop()
         cyclone.web.Application.stopFactory(self)
 
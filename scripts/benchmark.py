@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+"""
+Benchmark pyonionoo in-process on a synthetic summary file.
+
+The benchmark generates a summary file with gensummary.py (or uses the
+one given), starts the web application in this process on a local port
+and measures:
+
+  * ingest:  time to build the first snapshot, and to refresh it after a
+    fraction of the routers changed;
+  * queries:  latency percentiles and throughput of a mix of /summary
+    queries (filters, search, lookup, ordering, offset and cursor
+    pagination), each sent by several concurrent clients;
+  * refresh under load:  the same latencies while a refresh is running.
+
+Results are written as JSON, so that runs of different versions can be
+compared.  The same options and seed always send the same requests.
+Usage:
+
+    benchmark.py [--routers N] [--requests N] [--concurrency N] [--output FILE]
+"""
+
+import json
+import logging
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+import gensummary
+import pyonionoo
+from pyonionoo import compression, database, web
+
+CONFIG = """
+[frontend]
+locale_path = frontend/locale
+static_path = frontend/static
+template_path = frontend/template
+
+[metrics]
+out_dir = %(out_dir)s
+summary_file = summary
+details_dir =
+bandwidth_dir =
+
+[threads]
+pool_size = %(threads)d
+
+[cache]
+entries = %(cache_entries)d
+"""
+
+def get_statistics(latencies, elapsed, errors=0, sizes=()):
+    """
+    @type latencies: list of float
+    @param latencies: latency of every request, in seconds.
+
+    @type elapsed: float
+    @param elapsed: time it took to send all requests, in seconds.
+
+    @type sizes: list of int
+    @param sizes: size of every response body, as sent.
+
+    @rtype: dict
+    @return: request count, errors, throughput, latency statistics in
+        milliseconds and mean response size in bytes.
+    """
+
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+    percentile = lambda fraction: \
+            1000 * latencies[int(round(fraction * (len(latencies) - 1)))]
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / elapsed if elapsed else None,
+        'mean_ms': 1000 * sum(latencies) / len(latencies),
+        'p50_ms': percentile(0.5),
+        'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99),
+        'max_ms': 1000 * latencies[-1],
+        'mean_bytes': sum(sizes) / len(sizes) if sizes else None
+    }
+
+def get_query_mix(snapshot, rng):
+    """
+    @rtype: list of tuple
+    @return: (name, function returning the path of a request, share of the
+        number of requests) for every kind of /summary query.
+    """
+
+    rows = [rng.randrange(snapshot.size) for i in xrange(1000)]
+    fingerprints = [snapshot.fingerprint[row] for row in rows]
+    nicknames = [snapshot.nickname[row] for row in rows]
+    addresses = [snapshot.address[row] for row in rows]
+    countries = [country for country, share in gensummary.COUNTRIES]
+    size = snapshot.size
+
+    def path(**arguments):
+        return '/summary?' + urllib.urlencode(sorted(arguments.items()))
+
+    return [
+        ('all', lambda: '/summary', 0.1),
+        ('running_relays', lambda: path(type='relay', running='true',
+                                        limit=100,
+                                        offset=rng.randrange(size // 2)), 1),
+        ('country', lambda: path(country=rng.choice(countries)), 0.2),
+        ('search_nickname', lambda: path(
+                search=rng.choice(nicknames)[:rng.randint(3, 8)]), 1),
+        ('search_address', lambda: path(
+                search=rng.choice(addresses).rsplit('.', 1)[0]), 1),
+        ('lookup', lambda: path(lookup=rng.choice(fingerprints)), 1),
+        ('batch_lookup', lambda: path(lookup=','.join(
+                rng.sample(fingerprints, 100))), 0.5),
+        ('order_weight', lambda: path(order='-consensus_weight', limit=50,
+                                      offset=rng.randrange(1000)), 1),
+        ('order_fields', lambda: path(order='country,-consensus_weight',
+                                      running='true', limit=100,
+                                      offset=rng.randrange(1000)), 1),
+        ('offset_page', lambda: path(limit=100,
+                                     offset=rng.randrange(size)), 1)
+    ]
+
+def decode_body(body, encoding):
+    """
+    @rtype: string
+    @return: body decoded from its content encoding.
+    """
+
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'br':
+        return compression.brotli.decompress(body)
+    if encoding == 'zstd':
+        return compression.zstandard.ZstdDecompressor().decompressobj() \
+                .decompress(body)
+    return body
+
+class Client(object):
+    def __init__(self, port, concurrency, accept_encoding=None):
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = concurrency
+        self.agent = Agent(reactor, pool=pool)
+        self.base = 'http://127.0.0.1:%d' % port
+        self.concurrency = concurrency
+        self.pool = pool
+        self.headers = Headers()
+        if accept_encoding:
+            self.headers.addRawHeader('Accept-Encoding', accept_encoding)
+
+    @defer.inlineCallbacks
+    def get(self, path):
+        """
+        @rtype: Deferred
+        @return: fires with (status code, decoded body, latency in
+            seconds, size of the body as sent).
+        """
+
+        start = time.time()
+        response = yield self.agent.request('GET', self.base + path,
+                                            self.headers)
+        body = yield readBody(response)
+        latency = time.time() - start
+        encoding = response.headers.getRawHeaders('Content-Encoding', [None])[0]
+        defer.returnValue((response.code, decode_body(body, encoding),
+                           latency, len(body)))
+
+    @defer.inlineCallbacks
+    def run(self, make_paths):
+        """
+        Send requests with concurrency clients, each of them sending the
+        next request once it got the response to the previous one.
+
+        @type make_paths: callable
+        @param make_paths: function returning, for every client, an
+            iterator over the paths of its requests.
+
+        @rtype: Deferred
+        @return: fires with a list of (start, latency, status code, size)
+            for every request, and the total time.
+        """
+
+        results = []
+
+        @defer.inlineCallbacks
+        def send(paths):
+            for path in paths:
+                start = time.time()
+                code, body, latency, size = yield self.get(path)
+                results.append((start, latency, code, size))
+
+        start = time.time()
+        yield defer.gatherResults([send(make_paths())
+                                   for i in xrange(self.concurrency)])
+        defer.returnValue((results, time.time() - start))
+
+def write_summary(out_dir, lines):
+    # Replace the summary file atomically, and make sure its modification
+    # time is later than that of the current one.
+    path = os.path.join(out_dir, 'summary')
+    mtime = os.stat(path).st_mtime + 1 if os.path.exists(path) else None
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        f.writelines(lines)
+    if mtime is not None:
+        os.utime(temporary_path, (mtime, mtime))
+    os.rename(temporary_path, path)
+    return path
+
+def change_lines(lines, fraction, rng):
+    """
+    @rtype: list of string
+    @return: lines, with the consensus weight of a fraction of them
+        changed.
+    """
+
+    lines = list(lines)
+    for index in rng.sample(xrange(len(lines)), int(len(lines) * fraction)):
+        values = lines[index].split(' ')
+        values[9] = str(int(values[9]) + 1)
+        lines[index] = ' '.join(values)
+    return lines
+
+@defer.inlineCallbacks
+def run_benchmark(options, out_dir, results):
+    rng = random.Random(options.seed)
+    summary_file = os.path.join(out_dir, 'summary')
+    with open(summary_file) as f:
+        lines = f.readlines()
+    config_file = os.path.join(out_dir, 'pyonionoo.conf')
+    with open(config_file, 'w') as f:
+        f.write(CONFIG % {'out_dir': out_dir, 'threads': options.threads,
+                          'cache_entries': options.cache_entries})
+
+    start = time.time()
+    application = web.Application(config_file)
+    results['ingest'] = {'routers': database.SNAPSHOT.size,
+                         'full_seconds': time.time() - start}
+
+    port = reactor.listenTCP(0, application, interface='127.0.0.1')
+    # Refreshes are triggered by the benchmark, not by the watcher.
+    application.watcher.stop()
+    client = Client(port.getHost().port, options.concurrency,
+                    options.accept_encoding)
+
+    write_summary(out_dir, change_lines(lines, options.changed, rng))
+    start = time.time()
+    yield threads.deferToThread(database.update_databases, summary_file)
+    results['ingest']['changed_fraction'] = options.changed
+    results['ingest']['refresh_seconds'] = time.time() - start
+    results['ingest']['changes'] = database.LAST_CHANGES
+
+    results['queries'] = {}
+    for name, make_path, share in get_query_mix(database.SNAPSHOT, rng):
+        count = max(1, int(options.requests * share))
+        paths = iter([make_path() for i in xrange(count)])
+        requests, elapsed = yield client.run(lambda: paths)
+        results['queries'][name] = get_statistics(
+                [latency for start, latency, code, size in requests], elapsed,
+                sum(1 for start, latency, code, size in requests
+                    if code != 200),
+                [size for start, latency, code, size in requests])
+        logging.warning("%s: %s" % (name, results['queries'][name]))
+
+    # Page through results with cursors, every client from the start.
+    @defer.inlineCallbacks
+    def page(latencies, sizes):
+        path = '/summary?order=-consensus_weight&limit=100'
+        for i in xrange(options.pages):
+            code, body, latency, size = yield client.get(path)
+            latencies.append(latency)
+            sizes.append(size)
+            next_cursor = json.loads(body).get('next_cursor')
+            if next_cursor is None:
+                break
+            path = '/summary?order=-consensus_weight&limit=100&cursor=%s' % \
+                    str(next_cursor)
+
+    latencies, sizes = [], []
+    start = time.time()
+    yield defer.gatherResults([page(latencies, sizes)
+                               for i in xrange(options.concurrency)])
+    results['queries']['cursor_pages'] = get_statistics(
+            latencies, time.time() - start, sizes=sizes)
+
+    # Keep sending the query mix while a refresh runs.
+    mix = get_query_mix(database.SNAPSHOT, rng)
+    refreshing = [True]
+
+    def iter_load_paths():
+        while refreshing[0]:
+            yield rng.choice(mix)[1]()
+
+    write_summary(out_dir, change_lines(lines, options.changed, rng))
+    load = client.run(iter_load_paths)
+    yield task.deferLater(reactor, 0.5, lambda: None)
+    refresh_start = time.time()
+    yield threads.deferToThread(database.update_databases, summary_file)
+    refresh_end = time.time()
+    yield task.deferLater(reactor, 0.5, lambda: None)
+    refreshing[0] = False
+    requests, elapsed = yield load
+    during = [latency for start, latency, code, size in requests
+              if start < refresh_end and start + latency > refresh_start]
+    results['refresh_under_load'] = {
+        'refresh_seconds': refresh_end - refresh_start,
+        'during_refresh': get_statistics(during, refresh_end - refresh_start),
+        'total': get_statistics(
+                [latency for start, latency, code, size in requests], elapsed,
+                sizes=[size for start, latency, code, size in requests])
+    }
+
+    yield client.pool.closeCachedConnections()
+    yield port.stopListening()
+
+def get_version():
+    """
+    @rtype: string
+    @return: git commit of the working tree, or the package version.
+    """
+
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return pyonionoo.__version__
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--routers', type='int', default=10000,
+                      help="routers in the generated summary file "
+                           "(default: %default)")
+    parser.add_option('--summary', metavar='FILE',
+                      help="use this summary file instead of generating one")
+    parser.add_option('--seed', type='int', default=1,
+                      help="random seed (default: %default)")
+    parser.add_option('--requests', type='int', default=200,
+                      help="requests per kind of query (default: %default)")
+    parser.add_option('--pages', type='int', default=20,
+                      help="pages per client in cursor pagination "
+                           "(default: %default)")
+    parser.add_option('--concurrency', type='int', default=8,
+                      help="concurrent clients (default: %default)")
+    parser.add_option('--threads', type='int', default=10,
+                      help="thread pool size (default: %default)")
+    parser.add_option('--cache-entries', type='int', default=128,
+                      help="response cache entries; 0 disables the cache "
+                           "(default: %default)")
+    parser.add_option('--changed', type='float', default=0.05,
+                      help="fraction of routers changed by refreshes "
+                           "(default: %default)")
+    parser.add_option('--accept-encoding', metavar='ENCODINGS',
+                      help="Accept-Encoding header of the requests, e.g. "
+                           "gzip; responses are not compressed by default")
+    parser.add_option('--output', metavar='FILE',
+                      help="write results to FILE instead of stdout")
+    parser.add_option('--verbose', action='store_true',
+                      help="log the server's messages")
+    options, args = parser.parse_args()
+
+    # Configure logging before the application does, so that its
+    # messages are only shown with --verbose.
+    logging.basicConfig(format='%(asctime)s %(message)s',
+                        level=logging.INFO if options.verbose
+                        else logging.WARNING)
+
+    out_dir = tempfile.mkdtemp(prefix='pyonionoo-benchmark-')
+    summary_file = os.path.join(out_dir, 'summary')
+    results = {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+        'options': options.__dict__
+    }
+    if options.summary:
+        shutil.copyfile(options.summary, summary_file)
+    else:
+        start = time.time()
+        gensummary.generate(summary_file, options.routers, seed=options.seed)
+        logging.warning("Generated %d routers in %.1f s" %
+                        (options.routers, time.time() - start))
+
+    failures = []
+
+    def done(result):
+        if isinstance(result, Exception) or hasattr(result, 'getTraceback'):
+            failures.append(result)
+        reactor.stop()
+
+    reactor.callWhenRunning(
+            lambda: run_benchmark(options, out_dir, results).addBoth(done))
+    try:
+        reactor.run()
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    if failures:
+        failures[0].raiseException()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == "__main__":
+    main()
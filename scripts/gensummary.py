@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic summary file, in the format parsed by
+parser.parse_summary_columns(), for benchmarks and development.
+
+Routers get realistic distributions of flags, countries, consensus
+weights, nicknames and addresses, and the same seed always generates the
+same file.  Usage:
+
+    gensummary.py [--routers N] [--bridges FRACTION] [--seed SEED] FILE
+"""
+
+import datetime
+import optparse
+import random
+
+# Countries of relays, with their share of relays.  Relays in no listed
+# country are in '??'.
+COUNTRIES = (('de', 0.22), ('us', 0.18), ('fr', 0.07), ('nl', 0.06),
+             ('ru', 0.05), ('gb', 0.04), ('se', 0.04), ('ca', 0.03),
+             ('it', 0.02), ('at', 0.02), ('ch', 0.02), ('pl', 0.02),
+             ('ua', 0.02), ('ro', 0.015), ('cz', 0.015), ('jp', 0.01),
+             ('es', 0.01), ('fi', 0.01), ('au', 0.01), ('br', 0.01),
+             ('lu', 0.01), ('no', 0.01), ('dk', 0.01), ('a1', 0.005))
+
+# Probability of each flag, for relays and bridges.
+RELAY_FLAGS = (('Authority', 0.001), ('BadExit', 0.002), ('Exit', 0.12),
+               ('Fast', 0.75), ('HSDir', 0.35), ('Named', 0.35),
+               ('Running', 0.7), ('Stable', 0.55), ('Unnamed', 0.02),
+               ('V2Dir', 0.55), ('Valid', 0.98))
+BRIDGE_FLAGS = (('Fast', 0.6), ('Running', 0.7), ('Stable', 0.5),
+                ('Valid', 0.98))
+
+# Nickname stems; nicknames are a stem and a number, or 'Unnamed'.
+NICKNAMES = ('tor', 'relay', 'exit', 'node', 'onion', 'privacy', 'freedom',
+             'anon', 'torrelay', 'bridge', 'tornode', 'default', 'server')
+
+# Publication time of the most recent consensus.
+LAST_PUBLISHED = datetime.datetime(2012, 7, 3, 12, 0, 0)
+
+def _choose_country(rng):
+    value = rng.random()
+    for country, share in COUNTRIES:
+        value -= share
+        if value < 0:
+            return country
+    return '??'
+
+def _random_address(rng):
+    return '%d.%d.%d.%d' % (rng.randint(1, 223), rng.randint(0, 255),
+                            rng.randint(0, 255), rng.randint(1, 254))
+
+def generate_line(rng, index, bridge):
+    """
+    @type rng: random.Random
+    @param rng: random number generator.
+
+    @type index: int
+    @param index: number of the router in the file.
+
+    @type bridge: bool
+    @param bridge: whether to generate a bridge rather than a relay.
+
+    @rtype: string
+    @return: summary file line of a synthetic router.
+    """
+
+    flags = [flag for flag, probability in (BRIDGE_FLAGS if bridge
+                                            else RELAY_FLAGS)
+             if rng.random() < probability]
+    if 'Guard' not in flags and 'Fast' in flags and 'Stable' in flags and \
+            not bridge and rng.random() < 0.45:
+        flags.append('Guard')
+    flags = sorted(flags) or ['Valid']
+
+    if rng.random() < 0.03:
+        nickname = 'Unnamed'
+    else:
+        nickname = '%s%d' % (rng.choice(NICKNAMES), index % 100000)
+
+    address = _random_address(rng)
+    or_addresses = ''
+    if rng.random() < 0.08:
+        or_addresses = '[2001:db8::%x]:%d' % (index, rng.choice((443, 9001)))
+    exit_addresses = ''
+    if 'Exit' in flags and rng.random() < 0.3:
+        exit_addresses = _random_address(rng)
+
+    # Most routers are in the last consensus, the others in one of the
+    # previous week's.
+    hours = 0 if rng.random() < 0.7 else rng.randint(1, 7 * 24)
+    published = LAST_PUBLISHED - datetime.timedelta(hours=hours)
+
+    or_port = rng.choice((9001, 9001, 9001, 443, 443, rng.randint(1024, 65535)))
+    dir_port = 0 if bridge or rng.random() < 0.4 else rng.choice((9030, 80))
+    consensus_weight = 0 if bridge else \
+            min(int(rng.lognormvariate(7, 2)), 2000000)
+    country = '??' if bridge and rng.random() < 0.5 else _choose_country(rng)
+    hostname = 'null'
+    if rng.random() < 0.7:
+        hostname = 'host-%d.example.net' % index
+
+    return '%s %s %040X %s;%s;%s %s %d %d %s %d %s %s %d' % (
+            'b' if bridge else 'r', nickname, rng.getrandbits(160), address,
+            or_addresses, exit_addresses,
+            published.strftime('%Y-%m-%d %H:%M:%S'), or_port, dir_port,
+            ','.join(flags), consensus_weight, country, hostname,
+            1341316800000 + rng.randint(0, 86400000))
+
+def generate(path, routers, bridges=0.2, seed=1):
+    """
+    Write a synthetic summary file.
+
+    @type path: string
+    @param path: path of the file to write.
+
+    @type routers: int
+    @param routers: number of routers.
+
+    @type bridges: float
+    @param bridges: fraction of the routers that are bridges.
+
+    @type seed: int
+    @param seed: seed of the random number generator.
+    """
+
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for index in xrange(routers):
+            f.write(generate_line(rng, index, rng.random() < bridges) + '\n')
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(
+            usage="%prog [--routers N] [--bridges FRACTION] [--seed SEED] FILE")
+    parser.add_option('--routers', type='int', default=10000,
+                      help="number of routers (default: %default)")
+    parser.add_option('--bridges', type='float', default=0.2,
+                      help="fraction of bridges (default: %default)")
+    parser.add_option('--seed', type='int', default=1,
+                      help="random seed (default: %default)")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("missing output file")
+
+    generate(args[0], options.routers, options.bridges, options.seed)
@@ -0,0 +1,39 @@
+"""
+Shared fixtures:  small synthetic summary files and the snapshots built
+from them.
+"""
+
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+import gensummary
+from pyonionoo.snapshot import build_snapshot
+
+# Number of routers in the synthetic summary files.  Large enough for
+# every filter to match some routers but not all of them.
+ROUTERS = 400
+
+def generate_lines(routers=ROUTERS, seed=1, bridges=0.2):
+    """
+    @rtype: list of string
+    @return: lines of a synthetic summary file; see gensummary.generate().
+    """
+
+    rng = random.Random(seed)
+    return [gensummary.generate_line(rng, index, rng.random() < bridges)
+            for index in xrange(routers)]
+
+@pytest.fixture(scope='session')
+def summary_lines():
+    return generate_lines()
+
+@pytest.fixture(scope='session')
+def snapshot(summary_lines):
+    return build_snapshot(summary_lines, 1)[0]
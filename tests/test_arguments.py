@@ -0,0 +1,47 @@
+"""
+Cursor encoding and the checks of cursors against the served snapshot.
+"""
+
+import cyclone.web
+import pytest
+
+from pyonionoo.handlers import arguments
+from pyonionoo.snapshot import new_generation
+
+ORDER = (('consensus_weight', False), ('nickname', True))
+
+def test_cursor_round_trip(snapshot):
+    for order_fields in (None, ORDER):
+        cursor = snapshot.get_cursor(snapshot.size // 2, order_fields)
+        assert arguments.decode_cursor(arguments.encode_cursor(cursor)) == \
+                cursor
+
+@pytest.mark.parametrize('value', ['', 'x', 'bm90IGpzb24', 'WzEsIDJd'])
+def test_decode_invalid_cursor(value):
+    assert arguments.decode_cursor(value) is None
+
+def test_check_cursor(snapshot):
+    cursor = snapshot.get_cursor(3, ORDER)
+    parsed = arguments.parse({'order': ['-consensus_weight,nickname'],
+                              'cursor': [arguments.encode_cursor(cursor)]})
+    assert parsed['cursor'] == cursor
+    arguments.check_cursor(parsed, snapshot)
+
+    # The cursor must be used with the order it was created for.
+    parsed['order_fields'] = ORDER[:1]
+    with pytest.raises(cyclone.web.HTTPError) as excinfo:
+        arguments.check_cursor(parsed, snapshot)
+    assert excinfo.value.status_code == 400
+
+def test_check_cursor_after_refresh(snapshot):
+    """
+    Cursors of replaced snapshots are gone, even if their routers are
+    still the same.
+    """
+
+    cursor = snapshot.get_cursor(3, None)
+    parsed = arguments.parse({'cursor': [arguments.encode_cursor(cursor)]})
+    refreshed = snapshot.copy(new_generation(snapshot))
+    with pytest.raises(cyclone.web.HTTPError) as excinfo:
+        arguments.check_cursor(parsed, refreshed)
+    assert excinfo.value.status_code == 410
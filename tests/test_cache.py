@@ -0,0 +1,74 @@
+"""
+Behaviour of the response cache across snapshot generations.
+"""
+
+from pyonionoo.cache import ResponseCache
+
+def test_get_and_put():
+    cache = ResponseCache(2)
+    assert cache.get(1, 'a') is None
+    cache.put(1, 'a', 'A')
+    cache.put(1, 'b', 'B')
+    assert cache.get(1, 'a') == 'A'
+    # 'b' is now the least recently used entry.
+    cache.put(1, 'c', 'C')
+    assert cache.get(1, 'b') is None
+    assert cache.get(1, 'a') == 'A'
+    assert cache.get(1, 'c') == 'C'
+    assert (cache.hits, cache.misses) == (3, 2)
+
+def test_disabled():
+    cache = ResponseCache(0)
+    cache.put(1, 'a', 'A')
+    cache.put_staged(2, [('b', 'B')])
+    assert cache.get(1, 'a') is None
+    assert cache.get(2, 'b') is None
+
+def test_new_generation():
+    cache = ResponseCache(10)
+    cache.put(1, 'a', 'A')
+    assert cache.get(2, 'a') is None
+    # Responses still computed from the replaced snapshot are dropped.
+    cache.put(1, 'a', 'A')
+    assert cache.get(2, 'a') is None
+    cache.put(2, 'a', 'A2')
+    assert cache.get(2, 'a') == 'A2'
+
+def test_lower_generation():
+    """
+    A restarted loader may publish lower generations than before; the
+    cache follows them rather than ignoring them.
+    """
+
+    cache = ResponseCache(10)
+    cache.put(5, 'a', 'A5')
+    assert cache.get(3, 'a') is None
+    cache.put(3, 'a', 'A3')
+    assert cache.get(3, 'a') == 'A3'
+    assert cache.get(5, 'a') is None
+
+def test_staged():
+    cache = ResponseCache(2)
+    cache.put(1, 'a', 'A')
+    cache.put_staged(2, [('x', 'X'), ('a', 'A2'), ('b', 'B2')])
+    # The current generation is served until the new one is looked up.
+    assert cache.get(1, 'a') == 'A'
+    assert cache.get(2, 'a') == 'A2'
+    assert cache.get(2, 'b') == 'B2'
+    # Only the last max_entries staged responses are kept.
+    assert cache.get(2, 'x') is None
+    assert cache.get(1, 'a') is None
+
+def test_staged_for_current_generation():
+    cache = ResponseCache(10)
+    cache.put(1, 'a', 'A')
+    cache.put_staged(1, [('a', 'other')])
+    assert cache.get(1, 'a') == 'A'
+
+def test_clear():
+    cache = ResponseCache(10)
+    cache.put(1, 'a', 'A')
+    cache.put_staged(2, [('b', 'B')])
+    cache.clear()
+    assert cache.get(1, 'a') is None
+    assert cache.get(2, 'b') is None
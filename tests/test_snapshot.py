@@ -0,0 +1,171 @@
+"""
+Check Snapshot.select() against a brute-force filter over every router.
+"""
+
+import random
+
+import pytest
+
+from pyonionoo.snapshot import build_snapshot
+
+def brute_force_select(snapshot, running_filter=None, type_filter=None,
+                       lookup_filter=None, country_filter=None,
+                       search_filter=None, order_fields=None,
+                       offset_value=None, limit_value=None):
+    """
+    @rtype: list of int
+    @return: rows that Snapshot.select() should return, found by testing
+        every router.
+    """
+
+    def matches(router):
+        tokens = (router.fingerprint.lower(),
+                  router.hashed_fingerprint.lower(),
+                  router.nickname.lower(), router.address.lower())
+        if running_filter is not None and router.running != running_filter:
+            return False
+        if type_filter and router.type != type_filter:
+            return False
+        if country_filter and \
+                (router.country_code or '').lower() != country_filter.lower():
+            return False
+        if lookup_filter and not set(fingerprint.lower()
+                                     for fingerprint in lookup_filter) & \
+                set(tokens[:2]):
+            return False
+        for term in search_filter or ():
+            term = (term[1:] if term[0] == '$' else term).lower()
+            if not any(token.startswith(term) for token in tokens):
+                return False
+        return True
+
+    rows = [row for row in xrange(snapshot.size)
+            if matches(snapshot.get_router(row))]
+    if order_fields:
+        # Ties are ordered by row, in the direction of the first column.
+        rows.sort(reverse=not order_fields[0][1])
+        for column, ascending in reversed(order_fields):
+            values = getattr(snapshot, column)
+            rows.sort(key=values.__getitem__, reverse=not ascending)
+    offset_value = offset_value or 0
+    if limit_value:
+        return rows[offset_value:offset_value + limit_value]
+    return rows[offset_value:]
+
+def get_queries(snapshot, count=300, seed=1):
+    """
+    @rtype: list of dict
+    @return: random select() arguments, with values taken from the
+        routers of snapshot so that most filters match some of them.
+    """
+
+    rng = random.Random(seed)
+    orders = [(('consensus_weight', False),), (('nickname', True),),
+              (('country_code_lower', True), ('consensus_weight', False)),
+              (('nickname', False), ('country_code_lower', True))]
+    queries = [{}, {'search_filter': []}, {'running_filter': False},
+               {'lookup_filter': ['0' * 40]}]
+    while len(queries) < count:
+        router = snapshot.get_router(rng.randrange(snapshot.size))
+        query = {}
+        if rng.random() < 0.3:
+            query['running_filter'] = rng.random() < 0.7
+        if rng.random() < 0.3:
+            query['type_filter'] = rng.choice('rb')
+        if rng.random() < 0.3:
+            query['country_filter'] = rng.choice(
+                    (router.country_code, 'de', 'US', 'zz'))
+        if rng.random() < 0.2:
+            query['lookup_filter'] = [rng.choice(
+                    (router.fingerprint, router.hashed_fingerprint.upper()))] + \
+                    [snapshot.fingerprint[rng.randrange(snapshot.size)]
+                     for i in xrange(rng.randint(0, 3))]
+        if rng.random() < 0.3:
+            query['search_filter'] = [rng.choice(
+                    (router.nickname[:rng.randint(1, 6)],
+                     '$' + router.fingerprint[:rng.randint(1, 12)],
+                     router.address.split('.')[0] + '.',
+                     router.hashed_fingerprint[:8].upper()))]
+            if rng.random() < 0.2:
+                query['search_filter'].append(router.nickname[:2])
+        if rng.random() < 0.5:
+            query['order_fields'] = rng.choice(orders)
+        if rng.random() < 0.3:
+            query['offset_value'] = rng.randint(0, 50)
+        if rng.random() < 0.5:
+            query['limit_value'] = rng.choice((1, 10, 100))
+        queries.append(query)
+    return queries
+
+def test_select_matches_brute_force(snapshot):
+    for query in get_queries(snapshot):
+        assert snapshot.select(**query) == \
+                brute_force_select(snapshot, **query), query
+
+def test_select_is_unchanged_by_refresh(summary_lines, snapshot):
+    """
+    A snapshot refreshed from a changed summary file must answer like one
+    built from scratch.
+    """
+
+    rng = random.Random(2)
+    lines = list(summary_lines)
+    rng.shuffle(lines)
+    for index in xrange(0, len(lines), 10):
+        values = lines[index].split(' ')
+        values[1] = 'Renamed%d' % index
+        values[9] = str(rng.randint(0, 100000))
+        lines[index] = ' '.join(values)
+    del lines[::25]
+
+    refreshed, changes = build_snapshot(lines, 2, snapshot)
+    assert changes['deleted'] == len(summary_lines) - len(lines)
+    rebuilt = build_snapshot(lines, 2)[0]
+    for query in get_queries(rebuilt, 100, seed=3):
+        assert refreshed.select(**query) == rebuilt.select(**query), query
+        assert refreshed.select(**query) == \
+                brute_force_select(rebuilt, **query), query
+
+@pytest.mark.parametrize('order_fields', [
+    None,
+    (('consensus_weight', False),),
+    (('nickname', True), ('consensus_weight', True))])
+def test_cursor_pages(snapshot, order_fields):
+    """
+    Paging with cursors returns every matching router exactly once, in
+    order.
+    """
+
+    expected = snapshot.select(running_filter=True, order_fields=order_fields)
+    rows, cursor = [], None
+    while True:
+        page = snapshot.select(running_filter=True, order_fields=order_fields,
+                               limit_value=37, cursor=cursor)
+        if not page:
+            break
+        rows.extend(page)
+        cursor = snapshot.get_cursor(page[-1], order_fields)
+    assert rows == expected
+
+def test_cursor_of_other_snapshot(summary_lines, snapshot):
+    cursor = snapshot.get_cursor(0, None)
+    other = build_snapshot(summary_lines[1:], 2)[0]
+    with pytest.raises(ValueError):
+        other.select(cursor=cursor)
+
+def test_metadata_modified_times(summary_lines):
+    snapshot = build_snapshot(summary_lines, 1, summary_modified=1000.5)[0]
+    assert snapshot.metadata.summary_modified == 1000
+    assert snapshot.metadata.get_last_modified(('summary', 'details')) == 1000
+
+    # An unchanged summary file keeps the snapshot and its times.
+    unchanged = build_snapshot(summary_lines, 2, snapshot,
+                               summary_modified=2000)[0]
+    assert unchanged is snapshot
+
+    renamed = list(summary_lines)
+    renamed[0] = renamed[0].replace(' ', ' Renamed', 1)
+    changed = build_snapshot(renamed, 3, snapshot, summary_modified=3000)[0]
+    assert changed.metadata.generation == 3
+    assert changed.metadata.summary_modified == 3000
+    assert changed.metadata.details_modified is None
@@ -0,0 +1,118 @@
+"""
+Publishing snapshots to a snapshot file, and serving them mapped in a
+worker process.
+"""
+
+import json
+
+import pytest
+
+from pyonionoo import database
+from pyonionoo.snapshot import build_snapshot, new_generation
+from pyonionoo.snapshotfile import COLUMN_KINDS, MappedSnapshot, \
+        write_snapshot
+
+from test_snapshot import get_queries
+
+@pytest.fixture
+def metrics_dirs(tmpdir, summary_lines):
+    """
+    @return: (details_dir, bandwidth_dir) tuple of directories with the
+        details documents and bandwidth files of a few relays.
+    """
+
+    details_dir = tmpdir.mkdir('details')
+    bandwidth_dir = tmpdir.mkdir('bandwidth')
+    relays = [line.split()[2] for line in summary_lines
+              if line.startswith('r ')]
+    for index, fingerprint in enumerate(relays[:5]):
+        details_dir.join(fingerprint).write(json.dumps({
+                'contact': 'operator %d' % index,
+                'family': ['$' + relays[index + 1]],
+                'exit_policy': ['reject *:*']}))
+    lines = []
+    for interval in xrange(96):
+        start = '2012-07-02 %02d:%02d:00' % divmod(interval * 15, 60)
+        end = '2012-07-02 %02d:%02d:00' % divmod(interval * 15 + 15, 60) \
+                if interval < 95 else '2012-07-03 00:00:00'
+        lines.append('w %s %s %d' % (start, end, interval * 1000))
+        lines.append('r %s %s %d' % (start, end, interval * 2000))
+    bandwidth_dir.join(relays[0]).write('\n'.join(lines) + '\n')
+    return str(details_dir), str(bandwidth_dir)
+
+@pytest.fixture
+def worker(monkeypatch):
+    """
+    Start from a worker that has not mapped any snapshot yet.
+    """
+
+    monkeypatch.setattr(database, 'SNAPSHOT', None)
+    monkeypatch.setattr(database, 'SNAPSHOT_TIME', None)
+    monkeypatch.setattr(database, 'WARM_UP', None)
+
+def test_round_trip(tmpdir, summary_lines, metrics_dirs):
+    snapshot = build_snapshot(summary_lines, 1, None, *metrics_dirs)[0]
+    path = str(tmpdir.join('pyonionoo.snapshot'))
+    write_snapshot(snapshot, path)
+    mapped = MappedSnapshot(path)
+
+    assert mapped.generation == snapshot.generation
+    assert mapped.size == snapshot.size
+    rows = range(snapshot.size)
+    for column in COLUMN_KINDS:
+        assert mapped.get_rows(rows, (column,)) == \
+                snapshot.get_rows(rows, (column,)), column
+    for name in snapshot.metadata.__slots__:
+        assert getattr(mapped.metadata, name) == \
+                getattr(snapshot.metadata, name), name
+    assert mapped.rollups.cells == snapshot.rollups.cells
+    assert list(mapped.details.iter_entries(mapped, rows)) == \
+            list(snapshot.details.iter_entries(snapshot, rows))
+    assert list(mapped.bandwidth.iter_entries(mapped, rows)) == \
+            list(snapshot.bandwidth.iter_entries(snapshot, rows))
+    for query in get_queries(snapshot, 100):
+        assert mapped.select(**query) == snapshot.select(**query), query
+
+def test_worker_reload(tmpdir, summary_lines, worker):
+    path = str(tmpdir.join('pyonionoo.snapshot'))
+    first = build_snapshot(summary_lines, new_generation())[0]
+    write_snapshot(first, path)
+    database.load_snapshot(path)
+    mapped = database.SNAPSHOT
+    assert mapped.generation == first.generation
+
+    # The same file is not mapped again.
+    database.load_snapshot(path)
+    assert database.SNAPSHOT is mapped
+
+    second = build_snapshot(summary_lines[1:], new_generation(first), first)[0]
+    write_snapshot(second, path)
+    database.load_snapshot(path)
+    assert database.SNAPSHOT.generation == second.generation
+    assert database.SNAPSHOT.size == second.size
+
+def test_worker_follows_restarted_loader(tmpdir, summary_lines, worker):
+    """
+    A restarted loader publishes snapshots that the worker loads even if
+    their generation is not greater, or is the same, as the mapped one.
+    """
+
+    path = str(tmpdir.join('pyonionoo.snapshot'))
+    snapshot = build_snapshot(summary_lines, 2)[0]
+    write_snapshot(snapshot, path)
+    database.load_snapshot(path)
+    mapped = database.SNAPSHOT
+
+    for generation in (2, 1):
+        restarted = build_snapshot(summary_lines[generation:], generation)[0]
+        write_snapshot(restarted, path)
+        database.load_snapshot(path)
+        assert database.SNAPSHOT is not mapped
+        assert database.SNAPSHOT.size == restarted.size
+        mapped = database.SNAPSHOT
+
+def test_generations_are_unique():
+    generations = [new_generation() for i in xrange(100)]
+    assert len(set(generations)) > 90
+    previous = build_snapshot([], generations[-1])[0]
+    assert new_generation(previous) > previous.generation